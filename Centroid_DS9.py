@@ -2,19 +2,22 @@ import numpy as np
 import os
 from astropy.io import fits as pyfits
 from os import path
-from ReadRegions import read_region
+from ReadRegions import read_region, read_regions
+from concurrent.futures import ThreadPoolExecutor
 import re
 __version__ = '0.2.0'
 __author__ = 'Mihai Cara and Lia Eggleston'
 __vdate__ = '10-jul-2018'
 
 
-def imexcentroid(image, xyin=None):
+def imexcentroid(image, xyin=None, lazy=True):
 
     """
     Provided with an input image, the code will output centroid of the source within the guidebox
     provided by an open window of DS9, computed using the original IRAF's centroid algorithm. 
     Subtracts the average sky value taken from the first 10 rows of pixels in the image.
+    The input image is not modified; uint16 and float32 frames are used as-is and only
+    the guidebox cutout is converted to floating point.
 
     Parameters
     ----------
@@ -23,6 +26,10 @@ def imexcentroid(image, xyin=None):
             containing image data
 	xyin : either str or list
 	    Regions file name or a list of guidebox dimensions 
+	    [xcenter, ycenter, width, height]. Uses the whole image if None.
+	lazy : bool
+	    If True and image is a file name, memory-map the file and read
+	    only the guidebox and the sky rows instead of the whole frame.
 
     Returns
     -------
@@ -39,10 +46,13 @@ def imexcentroid(image, xyin=None):
 
     # get image data:
     if isinstance(image, str):
-        hdulist = pyfits.open(image)
-        scidata = hdulist[0].data
-        image = scidata
-    elif not isinstance(image, np.ndarray):
+        if not lazy:
+            with pyfits.open(image) as hdulist:
+                return imexcentroid(hdulist[0].data, xyin)
+        with pyfits.open(image, memmap=True,
+                         do_not_scale_image_data=True) as hdulist:
+            return imexcentroid(_FitsCutout(hdulist[0]), xyin)
+    elif not isinstance(image, (np.ndarray, _FitsCutout)):
         raise TypeError("Unsupported type for the 'image' parameter")
 
     # make sure we are dealing with 2D images:
@@ -54,76 +64,195 @@ def imexcentroid(image, xyin=None):
         xyin = read_region(xyin)
         if xyin == None:
             raise ValueError('Error: No guidebox detected in DS9 or regions file not properly saved')
-    elif not isinstance(xyin, list):
+    elif xyin is None:
+        # set to default values: use whole image
+        xyin = [image.shape[1]/2, image.shape[0]/2, image.shape[1], image.shape[0]]
+    elif not isinstance(xyin, (list, tuple)):
         raise TypeError("Unsupported type for the 'xyin' or guidebox dimensions parameter")
 
     # make sure width and height of guidebox > 0:
     if xyin[2] <= 0.0 or xyin[3] <= 0.0:
         raise ValueError("Width/height must be a strictly positive number")
 
-    # set xyin values to default if none given (will also be None if no guidebox is found in Ds9)
-    if xyin==None:
-        # set to default values: use whole image
-        xyin = [image.shape[1]/2, image.shape[0]/2, image.shape[1], image.shape[0]]
-
     ################################################
     ##  Main algorithm for computing centroid     ##
     ##  within the guidebox coordinates:          ##
     ################################################
 
-    centroid_xy = []
     ymax = image.shape[0] - 1
     xmax = image.shape[1] - 1
-    niter = range(3)
 
-    [xi, yi, w, h] = xyin
-    xc0 = xi
-    yc0 = yi
+    (x1, x2, y1, y2) = _guidebox_bounds(xyin, xmax, ymax)
+    box = image[y1:y2,x1:x2]
+
+    # take the avg flux of the first 10 rows as sky value
+    avgsky = _sky_level(image[(ymax-9):ymax+1, 0:xmax+1])
+
+    result = _centroid_box(box, x1, y1, avgsky)
+    if result is None:
+        return None
+    (xc, yc) = result[:2]
+
+    centroid_xy = [int(xc), int(yc)]
+
+    return centroid_xy
+
+
+def imexcentroid_batch(image, boxes, max_workers=None, lazy=True):
+
+    """
+    Centroids every guidebox in one image, spreading the boxes over a thread
+    pool. The sky level is measured once and shared by all boxes; NumPy releases
+    the GIL in the per-box reductions so the boxes are processed concurrently.
+
+    Parameters
+    ----------
+        image : str, numpy.ndarray
+            Either a string file name of an image file or a numpy.ndarrray
+            containing image data
+        boxes : either str or list
+            Regions file name (every box region in it is used) or a list of
+            guidebox dimensions [xcenter, ycenter, width, height]
+        max_workers : int
+            Size of the thread pool. Defaults to the executor's default.
+        lazy : bool
+            If True and image is a file name, memory-map the file and read
+            only the guideboxes and the sky rows.
+
+    Returns
+    -------
+        results : numpy.ndarray
+            Array of shape (N, 4) with one row [xcenter, ycenter, flux, peak]
+            per box, in the order of the boxes. Centroids are unrounded 1-based
+            pixel coordinates; rows of boxes without signal are NaN.
+
+    Examples
+    --------
+    >>> from Centroid_DS9 import imexcentroid_batch
+    >>> imexcentroid_batch('GAMimage162.fit', 'regions.reg')[:, :2]
+    array([[1653.2,  372.4]])
+
+    """
+
+    # get image data:
+    if isinstance(image, str):
+        if not lazy:
+            with pyfits.open(image) as hdulist:
+                return imexcentroid_batch(hdulist[0].data, boxes, max_workers)
+        with pyfits.open(image, memmap=True,
+                         do_not_scale_image_data=True) as hdulist:
+            return imexcentroid_batch(_FitsCutout(hdulist[0]), boxes,
+                                      max_workers)
+    elif not isinstance(image, (np.ndarray, _FitsCutout)):
+        raise TypeError("Unsupported type for the 'image' parameter")
+
+    # make sure we are dealing with 2D images:
+    if len(image.shape) != 2:
+        raise ValueError("Input image must 2-dimensional")
+
+    # get region data for the guideboxes:
+    if isinstance(boxes, str):
+        boxes = read_regions(boxes, save=False)
+    elif not isinstance(boxes, (list, tuple, np.ndarray)):
+        raise TypeError("Unsupported type for the 'boxes' parameter")
+
+    for xyin in boxes:
+        if xyin[2] <= 0.0 or xyin[3] <= 0.0:
+            raise ValueError("Width/height must be a strictly positive number")
+
+    ymax = image.shape[0] - 1
+    xmax = image.shape[1] - 1
+    bounds = [_guidebox_bounds(xyin, xmax, ymax) for xyin in boxes]
+
+    # take the avg flux of the first 10 rows as sky value
+    avgsky = _sky_level(image[(ymax-9):ymax+1, 0:xmax+1])
+
+    def centroid_one(box_bounds):
+        (x1, x2, y1, y2) = box_bounds
+        return _centroid_box(image[y1:y2,x1:x2], x1, y1, avgsky)
+
+    results = np.full((len(bounds), 4), np.nan)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for i, result in enumerate(pool.map(centroid_one, bounds)):
+            if result is not None:
+                results[i] = result
+
+    return results
+
+
+def _guidebox_bounds(xyin, xmax, ymax):
+    # xyin - guidebox [xcenter, ycenter, width, height] in 1-based
+    #        (DS9 physical) pixel coordinates
+    # Returns 0-based slice bounds (x1, x2, y1, y2) clipped to the image.
+    [xi, yi, w, h] = xyin[:4]
     xradius = w/2
     yradius = h/2
-   
+
     # find the bounding box for extraction
-    x1 = int(xc0 - xradius + 0.5)
-    x2 = int(xc0 + xradius + 0.5)
-    y1 = int(yc0 - yradius + 0.5)
-    y2 = int(yc0 + yradius + 0.5)
+    x1 = int(xi - xradius + 0.5)
+    x2 = int(xi + xradius + 0.5)
+    y1 = int(yi - yradius + 0.5)
+    y2 = int(yi + yradius + 0.5)
 
-    (x1, x2, y1, y2) = _inbounds_box(x1-1, x2-1, y1-1, y2-1, xmax, ymax)
-    box = image[y1:y2,x1:x2]
+    return _inbounds_box(x1-1, x2-1, y1-1, y2-1, xmax, ymax)
 
-    # create lists of coordinates
-    xs = np.arange(x1+1,x2+1)
-    ys = np.arange(y1+1,y2+1)
-
-    # take the avg flux of the first 10 rows as sky value and subtract from guidebox
-    rows = image[(ymax-9):ymax+1, 0:xmax+1]
-    avgsky = np.mean(rows)
-    for i in range(0, y2-y1):
-        for j in range(0,x2-x1):
-            if box[i,j] <= avgsky:
-                box[i,j] = 0
-            else:
-                box[i,j] = box[i,j]-avgsky
-
-    # compute marginal distribution for x-axis
-    margx = box.sum(axis=0, dtype=np.float64)
-    meanx = margx.mean()
-    margx -= meanx
-    goodx = margx > 0.0 # no data
-    if not goodx.any():
-          xc = np.nan
-          yc = np.nan
-          return None
-
-    # compute marginal distribution for y-axis
-    margy = box.sum(axis=1, dtype=np.float64)
-    meany = margy.mean()
-    margy -= meany
+
+def _sky_level(rows):
+    # Mean of the sky rows, accumulated in float64 so uint16 and float32
+    # frames neither overflow nor lose precision.
+    return float(np.mean(rows, dtype=np.float64))
+
+
+def _centroid_box(box, x1, y1, sky):
+    """
+    Sky-subtracted marginal centroid of a guidebox cutout.
+
+    The cutout is never written to: sky subtraction is done on a
+    temporary in the smallest float type that holds the data (float32
+    for uint16/float32 frames), so the caller's image is left untouched.
+
+    Parameters
+    ----------
+        box : numpy.ndarray
+            2D cutout of the image inside the guidebox
+        x1, y1 : int
+            0-based image coordinates of ``box[0, 0]``
+        sky : float
+            Sky level to subtract; pixels at or below it are set to 0
+
+    Returns
+    -------
+        result : tuple or None
+            ``(xc, yc, flux, peak)`` with 1-based centroid coordinates,
+            the sky-subtracted flux and the sky-subtracted peak value, or
+            None if the box holds no signal above the background
+
+    """
+    if box.size == 0:
+        return None
+
+    # subtract the sky and clip negative values to zero
+    work = np.subtract(box, sky, dtype=np.result_type(box.dtype, np.float32))
+    np.maximum(work, 0, out=work)
+
+    # compute marginal distributions along each axis
+    margx = work.sum(axis=0, dtype=np.float64)
+    margy = work.sum(axis=1, dtype=np.float64)
+    flux = margx.sum()
+
+    margx -= margx.mean()
+    goodx = margx > 0.0
+    if not goodx.any(): # no data
+        return None
+
+    margy -= margy.mean()
     goody = margy > 0.0
     if not goody.any(): # no data
-          xc = np.nan
-          yc = np.nan
-          return None
+        return None
+
+    # create lists of coordinates
+    xs = np.arange(x1+1, x1+1+work.shape[1])
+    ys = np.arange(y1+1, y1+1+work.shape[0])
 
     # compute centroid
     margx_good = margx[goodx]
@@ -131,9 +260,31 @@ def imexcentroid(image, xyin=None):
     xc = np.dot(xs[goodx], margx_good) / margx_good.sum()
     yc = np.dot(ys[goody], margy_good) / margy_good.sum()
 
-    centroid_xy = [int(xc), int(yc)]
+    return (xc, yc, flux, float(work.max()))
 
-    return centroid_xy
+
+class _FitsCutout(object):
+    # Read-only 2D view of a memory-mapped FITS HDU. Slicing touches only
+    # the pages holding the requested rows, and BZERO/BSCALE scaling is
+    # applied to the cutout alone, so the full frame is never loaded.
+    def __init__(self, hdu):
+        header = hdu.header
+        self.shape = tuple(header['NAXIS%d' % n]
+                           for n in range(header['NAXIS'], 0, -1))
+        self._bscale = header.get('BSCALE', 1)
+        self._bzero = header.get('BZERO', 0)
+        self._data = hdu.data
+
+    def __getitem__(self, key):
+        raw = self._data[key]
+        if self._bscale == 1 and self._bzero == 0:
+            return np.array(raw)
+        if (self._bscale == 1 and raw.dtype.kind == 'i' and
+                self._bzero == 2**(8*raw.dtype.itemsize - 1)):
+            # unsigned integers stored with the FITS sign-bit offset
+            unsigned = raw.dtype.newbyteorder('=').str.replace('i', 'u')
+            return raw.astype(unsigned) ^ np.array(self._bzero, unsigned)
+        return raw * np.float32(self._bscale) + np.float32(self._bzero)
 
 
 def _inbounds_box(x1, x2, y1, y2, xmax, ymax):
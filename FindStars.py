@@ -0,0 +1,186 @@
+import numpy as np
+from astropy.io import fits as pyfits
+from Centroid_DS9 import _centroid_box
+
+try:
+    from scipy import ndimage
+    scipy_loaded = True
+except ImportError:
+    scipy_loaded = False
+
+
+def find_stars(image, nsigma=5.0, factor=4, tile=32, minpix=2, maxstars=50):
+
+    """
+    Detects stars over the full frame so a guide star can be chosen without
+    a hand-drawn DS9 box. The frame is block-averaged by 'factor' (a two-level
+    image pyramid), thresholded at 'nsigma' above a tiled median background,
+    and the connected components of the mask are refined with the guidebox
+    centroid algorithm at full resolution.
+
+    Parameters
+    ----------
+        image : str, numpy.ndarray
+            Either a string file name of an image file or a numpy.ndarrray
+            containing image data
+        nsigma : float
+            Detection threshold in units of the background noise
+        factor : int
+            Downsampling factor of the detection image
+        tile : int
+            Background tile size in pixels of the detection image
+        minpix : int
+            Minimum number of detection image pixels in a star
+        maxstars : int
+            Maximum number of stars returned
+
+    Returns
+    -------
+        stars : numpy.ndarray
+            Array of shape (N, 4) with one row [xcenter, ycenter, flux, peak]
+            per star in 1-based pixel coordinates, brightest first
+
+    Examples
+    --------
+    >>> from FindStars import find_stars
+    >>> find_stars('RefractorImage_temp-G.fits')[:2, :2]
+    array([[3801.3, 1691.7],
+           [1202.8,  655.1]])
+
+    """
+
+    # get image data:
+    if isinstance(image, str):
+        image = pyfits.getdata(image)
+    elif not isinstance(image, np.ndarray):
+        raise TypeError("Unsupported type for the 'image' parameter")
+
+    # make sure we are dealing with 2D images:
+    if len(image.shape) != 2:
+        raise ValueError("Input image must 2-dimensional")
+
+    small = _downsample(image, factor)
+    (bkg, rms) = _tiled_background(small, tile)
+    mask = small > bkg + nsigma*rms
+
+    (labels, nlabels) = _label(mask)
+    if nlabels == 0:
+        return np.empty((0, 4))
+
+    # measure every component on the detection image
+    index = np.arange(1, nlabels+1)
+    flat = labels.ravel()
+    signal = (small - bkg).ravel()
+    npix = np.bincount(flat, minlength=nlabels+1)[1:]
+    flux = np.bincount(flat, weights=signal, minlength=nlabels+1)[1:]
+    (ys, xs) = np.indices(small.shape)
+    ysum = np.bincount(flat, weights=ys.ravel()*signal, minlength=nlabels+1)[1:]
+    xsum = np.bincount(flat, weights=xs.ravel()*signal, minlength=nlabels+1)[1:]
+
+    good = (npix >= minpix) & (flux > 0)
+    order = index[good][np.argsort(-flux[good])][:maxstars]
+
+    # refine the brightest components at full resolution
+    ymax = image.shape[0] - 1
+    xmax = image.shape[1] - 1
+    stars = []
+    for label in order:
+        i = label - 1
+        # component centre and radius in full resolution pixels
+        yc = (ysum[i]/flux[i] + 0.5)*factor
+        xc = (xsum[i]/flux[i] + 0.5)*factor
+        radius = int(factor*(np.sqrt(npix[i]) + 2))
+        x1 = max(int(xc) - radius, 0)
+        x2 = min(int(xc) + radius, xmax) + 1
+        y1 = max(int(yc) - radius, 0)
+        y2 = min(int(yc) + radius, ymax) + 1
+        sky = bkg[min(int(yc)//factor, bkg.shape[0]-1),
+                  min(int(xc)//factor, bkg.shape[1]-1)]
+        result = _centroid_box(image[y1:y2,x1:x2], x1, y1, sky)
+        if result is not None:
+            stars.append(result)
+
+    if not stars:
+        return np.empty((0, 4))
+    stars = np.array(stars)
+    return stars[np.argsort(-stars[:, 2])]
+
+
+def pick_star(stars, fiber=None):
+
+    """
+    Picks the guide star from a find_stars list: the brightest star, or the
+    star nearest to the fiber position if one is given as (x, y). Returns
+    None if the list is empty.
+    """
+
+    if len(stars) == 0:
+        return None
+    if fiber is None:
+        return stars[0]
+    dist = np.hypot(stars[:, 0] - fiber[0], stars[:, 1] - fiber[1])
+    return stars[np.argmin(dist)]
+
+
+def star_guidebox(star, size=100):
+
+    """
+    Returns the guidebox [xcenter, ycenter, width, height] of a square box of
+    'size' pixels around a find_stars row, for use with imexcentroid or DS9.
+    """
+
+    return [float(star[0]), float(star[1]), size, size]
+
+
+def _downsample(image, factor):
+    # Block average by 'factor' along both axes; rows and columns that do
+    # not fill a whole block are dropped.
+    if factor <= 1:
+        return image.astype(np.float32)
+    ny = image.shape[0] // factor
+    nx = image.shape[1] // factor
+    blocks = image[:ny*factor, :nx*factor].reshape(ny, factor, nx, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def _tiled_background(image, tile):
+    # Median and robust (MAD) noise per tile, expanded back to a per-pixel
+    # map. Edge tiles are padded by repeating the last row/column.
+    ny = -(-image.shape[0] // tile)
+    nx = -(-image.shape[1] // tile)
+    padded = np.pad(image, ((0, ny*tile - image.shape[0]),
+                            (0, nx*tile - image.shape[1])), mode='edge')
+    tiles = padded.reshape(ny, tile, nx, tile).transpose(0, 2, 1, 3)
+    tiles = tiles.reshape(ny, nx, tile*tile)
+    med = np.median(tiles, axis=2)
+    mad = np.median(np.abs(tiles - med[:, :, None]), axis=2)
+    rms = np.maximum(1.4826*mad, np.finfo(np.float32).eps)
+
+    shape = image.shape
+    bkg = np.repeat(np.repeat(med, tile, axis=0), tile, axis=1)
+    rms = np.repeat(np.repeat(rms, tile, axis=0), tile, axis=1)
+    return (bkg[:shape[0], :shape[1]], rms[:shape[0], :shape[1]])
+
+
+def _label(mask):
+    # Label 8-connected components of a boolean mask. Uses scipy if it is
+    # installed, otherwise a flood fill over the (few) masked pixels.
+    if scipy_loaded:
+        return ndimage.label(mask, structure=np.ones((3, 3)))
+
+    labels = np.zeros(mask.shape, dtype=np.int32)
+    nlabels = 0
+    for (y0, x0) in zip(*np.nonzero(mask)):
+        if labels[y0, x0]:
+            continue
+        nlabels += 1
+        labels[y0, x0] = nlabels
+        stack = [(y0, x0)]
+        while stack:
+            (y, x) = stack.pop()
+            for yy in range(max(y-1, 0), min(y+2, mask.shape[0])):
+                for xx in range(max(x-1, 0), min(x+2, mask.shape[1])):
+                    if mask[yy, xx] and not labels[yy, xx]:
+                        labels[yy, xx] = nlabels
+                        stack.append((yy, xx))
+    return (labels, nlabels)
@@ -1,23 +1,112 @@
-import os
+import os, re
+from collections import namedtuple
+
+# typed DS9 regions in pixel coordinates; system is 'physical' or 'image'
+# and props holds the properties after '#' (e.g. color, point, text)
+Box = namedtuple('Box', 'x y width height angle system props')
+Circle = namedtuple('Circle', 'x y radius system props')
+Ellipse = namedtuple('Ellipse', 'x y a b angle system props')
+Point = namedtuple('Point', 'x y system props')
+Polygon = namedtuple('Polygon', 'points system props')
+
+PIXEL_SYSTEMS = ('physical', 'image')
+SKY_SYSTEMS = ('fk4', 'fk5', 'icrs', 'galactic', 'ecliptic', 'j2000',
+	       'b1950', 'wcs', 'linear', 'amplifier', 'detector')
+
+_SHAPE = re.compile(r'([+-]?)\s*([a-z]+)\s*\((.*)\)\s*$')
+_PROP = re.compile(r'(\w+)\s*=\s*(\{[^}]*\}|"[^"]*"|\'[^\']*\'|'
+		   r'\S+(?:\s+\d+(?=\s|$))?)')
 
 def read_region(filepath):
+	# return the dimensions of the first guidebox:
+	# [xcenter, ycenter, width, height]
+	boxes = read_regions(filepath)
+	if not boxes:
+		return None
+	return boxes[0]
+
+def read_regions(filepath, save=True):
 	# save the current regions to a regions file
-	os.system('xpaset -p ds9 regions save '+filepath)
-	# open that same regions file to read each line and find the guidebox info
-	rfile = open(filepath, 'r')
-	dimensions=None
-	for line in rfile:
-		if line.split('(')[0] == 'box':
-			boxline = line.split('(')[1].split(')')[0]
-			dimensions = boxline.split(',')
-			for i in range(len(dimensions)):
-				dimensions[i] = int(float(dimensions[i]))
-			dimensions = dimensions[:4]
-			break
-	rfile.close()
-	# return the dimensions of the guidebox: [xcenter, ycenter, width, height]
-	return dimensions
+	if save:
+		os.system('xpaset -p ds9 regions save '+filepath)
+	# open that same regions file and collect the info of every
+	# guidebox
+	with open(filepath, 'r') as rfile:
+		regions = parse_regions(rfile.read())
+	# return a list of [xcenter, ycenter, width, height] per box
+	return [box_guidebox(r) for r in regions if isinstance(r, Box)]
+
+def get_regions(ds9, system='physical'):
+	# fetch the current regions straight from DS9 over XPA (ds9 is a
+	# refractor_ds9.DS9Session or pyds9.DS9), without a regions file
+	return parse_regions(ds9.get('regions -format ds9 -system ' + system))
+
+def box_guidebox(box):
+	# [xcenter, ycenter, width, height] of a Box, as in regions.reg
+	return [int(box.x), int(box.y), int(box.width), int(box.height)]
+
+def parse_regions(text):
+	# parse DS9 region text (file or XPA reply) into typed regions;
+	# shapes in sky coordinates and unsupported shapes are skipped
+	regions = []
+	system = 'physical'
+	for line in text.splitlines():
+		# the properties after '#' belong to the last shape of the
+		# line; ';' separates shapes and coordinate systems
+		(body, sep, comment) = line.partition('#')
+		if not body.strip():
+			continue
+		parts = [p.strip() for p in body.split(';')]
+		parts = [p for p in parts if p]
+		for (i, part) in enumerate(parts):
+			word = part.lower()
+			if word.startswith('global'):
+				continue
+			if word in PIXEL_SYSTEMS or word in SKY_SYSTEMS or \
+			   word.startswith('wcs'):
+				system = word
+				continue
+			props = _props(comment) if i == len(parts)-1 else {}
+			region = _region(part, system, props)
+			if region is not None:
+				regions.append(region)
+	return regions
+
+def _region(text, system, props):
+	match = _SHAPE.match(text.strip().lower())
+	if match is None or system not in PIXEL_SYSTEMS:
+		return None
+	(sign, shape, args) = match.groups()
+	try:
+		values = [float(v) for v in re.split(r'[\s,]+', args.strip())]
+	except ValueError:
+		return None
+	if sign == '-':
+		props['exclude'] = True
+	n = len(values)
+	if shape == 'box' and n >= 4:
+		angle = values[4] if n == 5 else (values[-1] if n > 5 else 0.)
+		return Box(values[0], values[1], values[2], values[3], angle,
+			   system, props)
+	if shape == 'circle' and n >= 3:
+		return Circle(values[0], values[1], values[2], system, props)
+	if shape == 'ellipse' and n >= 4:
+		angle = values[4] if n >= 5 else 0.
+		return Ellipse(values[0], values[1], values[2], values[3],
+			       angle, system, props)
+	if shape == 'point' and n >= 2:
+		return Point(values[0], values[1], system, props)
+	if shape == 'polygon' and n >= 6 and n % 2 == 0:
+		return Polygon(list(zip(values[0::2], values[1::2])), system,
+			       props)
+	return None
+
+def _props(comment):
+	props = {}
+	for (key, value) in _PROP.findall(comment):
+		props[key] = value.strip('{}"\'')
+	return props
 
 # testing with regions.reg
 #print (read_region('/home/fhire/Desktop/Refractor/regions.reg'))
-
+#print (read_regions('/home/fhire/Desktop/Refractor/regions.reg', save=False))
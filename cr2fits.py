@@ -23,7 +23,11 @@ try:
     import os.path
     from io import BytesIO
     import math
-    from copy import deepcopy
+    import struct
+    import glob
+    import time
+    import threading
+    from concurrent.futures import ProcessPoolExecutor
 
 except Exception as err:
     print("Error: Missing some libraries!")
@@ -32,7 +36,20 @@ except Exception as err:
 
 
 class NetpbmFile(object):
-    """Read and write Netpbm PAM, PBM, PGM, PPM, files."""
+    r"""
+    Read and write Netpbm PAM, PBM, PGM, PPM, files.
+
+    Binary files with several images, each with its own header, are read
+    into a stack of images:
+
+    >>> two = b"P5\n2 1\n255\n\x01\x02" + b"P5\n2 1\n255\n\x03\x04"
+    >>> NetpbmFile(BytesIO(two)).asarray().tolist()
+    [[[1, 2]], [[3, 4]]]
+    >>> two = b"P6\n1 1\n255\n\x01\x02\x03" + b"P6\n1 1\n255\n\x04\x05\x06"
+    >>> NetpbmFile(BytesIO(two)).asarray().tolist()
+    [[[[1, 2, 3]]], [[[4, 5, 6]]]]
+
+    """
 
     # This class was written by Christoph Gohlke,
     # Modified by M. Emre Aydin to include in cr2fits
@@ -82,7 +99,8 @@ class NetpbmFile(object):
     def __init__(self, filename):
         """Initialize instance from filename or open file."""
         for attr in ('header', 'magicnum', 'width', 'height', 'maxval',
-                     'depth', 'tupltypes', '_filename', '_fh', '_data'):
+                     'depth', 'tupltypes', '_filename', '_fh', '_data',
+                     '_head'):
             setattr(self, attr, None)
         if filename is None:
             return
@@ -92,17 +110,12 @@ class NetpbmFile(object):
             self._fh = open(filename, 'rb')
             self._filename = filename
 
-        self._fh.seek(0)
-        data = self._fh.read(4096)
-        if (len(data) < 7) or not (b'0' < data[1:2] < b'8'):
-            raise ValueError("Not a Netpbm file:\n%s" % data[:32])
-        try:
-            self._read_pam_header(data)
-        except Exception:
-            try:
-                self._read_pnm_header(data)
-            except Exception:
-                raise ValueError("Not a Netpbm file:\n%s" % data[:32])
+        # Pipes cannot seek back, so the bytes read past the header are
+        # kept and used as the start of the pixel data.
+        if self._seekable(self._fh):
+            self._fh.seek(0)
+        data = self._head = self._fh.read(4096)
+        self._read_header(data)
 
     @classmethod
     def fromdata(cls, data, maxval=None):
@@ -145,7 +158,7 @@ class NetpbmFile(object):
                 self._data = data
             else:
                 return data
-        return deepcopy(data) if copy else data
+        return data.copy() if copy else data
 
     def write(self, filename, pam=False):
         """Write instance to file."""
@@ -171,6 +184,18 @@ class NetpbmFile(object):
         """Return information about instance."""
         return unicode(self.header)
 
+    def _read_header(self, data):
+        """Read PAM or PNM header and initialize instance."""
+        if (len(data) < 7) or not (b'0' < data[1:2] < b'8'):
+            raise ValueError("Not a Netpbm file:\n%s" % data[:32])
+        try:
+            self._read_pam_header(data)
+        except Exception:
+            try:
+                self._read_pnm_header(data)
+            except Exception:
+                raise ValueError("Not a Netpbm file:\n%s" % data[:32])
+
     def _read_pam_header(self, data):
         """Read PAM header and initialize instance."""
         regroups = re.search(
@@ -202,23 +227,30 @@ class NetpbmFile(object):
         self.tupltypes = [self._types[self.magicnum]]
 
     def _read_data(self, fh, byteorder='>'):
-        """Return image data from open file as numpy array."""
-        fh.seek(len(self.header))
-        data = fh.read()
+        """
+        Return image data from open file as numpy array.
+
+        All images of a binary file or buffer are read, each after its own
+        header, into a stack; plain (ASCII) files and pipes give the first
+        image.
+        """
         dtype = 'u1' if self.maxval < 256 else byteorder + 'u2'
         depth = 1 if self.magicnum == b"P7 332" else self.depth
-        shape = [-1, self.height, self.width, depth]
-        size = np.prod(shape[1:], dtype='int64')
+        shape = [1, self.height, self.width, depth]
         if self.magicnum in b"P1P2P3":
-            data = np.array(data.split(None, size)[:size], dtype)
+            data = self._read_ascii(fh, np.prod(shape, dtype='int64'), dtype)
             data = data.reshape(shape)
-        elif self.maxval == 1:
-            shape[2] = int(math.ceil(self.width / 8))
-            data = np.frombuffer(data, dtype).reshape(shape)
-            data = np.unpackbits(data, axis=-2)[:, :, :self.width, :]
         else:
-            size *= np.dtype(dtype).itemsize
-            data = np.frombuffer(data[:size], dtype).reshape(shape)
+            if self.maxval == 1:
+                shape[2] = int(math.ceil(self.width / 8))
+                dtype = 'u1'
+            data = self._read_binary(fh, shape, dtype)
+            if self._seekable(fh):
+                more = self._read_more(fh, shape, dtype)
+                if more:
+                    data = np.concatenate([data] + more)
+            if self.maxval == 1:
+                data = np.unpackbits(data, axis=-2)[:, :, :self.width, :]
         if data.shape[0] < 2:
             data = data.reshape(data.shape[1:])
         if data.shape[-1] < 2:
@@ -229,6 +261,95 @@ class NetpbmFile(object):
             data = np.take(rgb332, data, axis=0)
         return data
 
+    def _read_more(self, fh, shape, dtype):
+        """Return the images after the first one, each after its header."""
+        nbytes = int(np.prod(shape, dtype='int64')) * np.dtype(dtype).itemsize
+        offset = len(self.header) + nbytes
+        images = []
+        while True:
+            fh.seek(offset)
+            data = fh.read(4096)
+            if not data.strip():
+                return images
+            image = NetpbmFile(None)
+            image._read_header(data)
+            if (image.magicnum, image.width, image.height, image.maxval,
+                    image.depth) != (self.magicnum, self.width, self.height,
+                                     self.maxval, self.depth):
+                raise ValueError("Netpbm images differ in size or type")
+            offset += len(image.header)
+            images.append(self._read_binary(fh, shape, dtype, offset))
+            offset += nbytes
+
+    def _read_binary(self, fh, shape, dtype, offset=None):
+        """
+        Return the binary pixel block without intermediate copies.
+
+        In-memory buffers are wrapped, regular files are memory-mapped and
+        pipes are read once into a preallocated array. The block starts at
+        offset, by default right after the first header.
+        """
+        if offset is None:
+            offset = len(self.header)
+        count = int(np.prod(shape, dtype='int64'))
+        nbytes = count * np.dtype(dtype).itemsize
+        if isinstance(fh, BytesIO):
+            return np.frombuffer(fh.getbuffer(), dtype, count,
+                                 offset).reshape(shape)
+        if self._seekable(fh):
+            try:
+                fh.fileno()
+                return np.memmap(fh, dtype, mode='r', offset=offset,
+                                 shape=tuple(shape))
+            except (AttributeError, IOError, ValueError):
+                pass
+            fh.seek(offset)
+            head = b''
+        else:
+            head = self._head[offset:offset + nbytes]
+
+        data = np.empty(shape, dtype)
+        buf = memoryview(data.reshape(-1).view(np.uint8))
+        buf[:len(head)] = head
+        pos = len(head)
+        while pos < nbytes:
+            n = fh.readinto(buf[pos:])
+            if not n:
+                raise ValueError("Netpbm data is truncated")
+            pos += n
+        return data
+
+    def _read_ascii(self, fh, size, dtype):
+        """Parse plain (P1, P2, P3) pixel values with vectorized Numpy."""
+        offset = len(self.header)
+        if self._seekable(fh):
+            fh.seek(offset)
+            text = fh.read()
+        else:
+            text = self._head[offset:] + fh.read()
+        chars = np.frombuffer(text, np.uint8)
+        index = np.flatnonzero((chars >= 48) & (chars <= 57))
+        digits = chars[index].astype('int64') - 48
+        if self.magicnum == b"P1":
+            # Plain PBM pixels are single digits, separators optional.
+            return digits[:size].astype(dtype)
+        # Numbers are runs of consecutive digits; weight every digit by
+        # its power of ten within the run and sum the runs.
+        breaks = np.diff(index) != 1
+        starts = np.flatnonzero(np.r_[True, breaks])
+        ends = index[np.r_[breaks, True]]
+        run = np.cumsum(np.r_[True, breaks]) - 1
+        digits *= 10 ** (ends[run] - index)
+        return np.add.reduceat(digits, starts)[:size].astype(dtype)
+
+    @staticmethod
+    def _seekable(fh):
+        """Return True if fh can seek back (files and buffers)."""
+        try:
+            return fh.seekable()
+        except AttributeError:
+            return hasattr(fh, 'seek')
+
     def _tofile(self, fh, pam=False):
         """Write Netpbm file."""
         fh.seek(0)
@@ -260,6 +381,188 @@ class NetpbmFile(object):
         return header
 
 
+def demosaic(mosaic, pattern, index):
+    """
+    Full resolution color plane from a Bayer mosaic.
+
+    Bilinear interpolation: pixels of the requested color keep their raw
+    value, the others get the mean of their nearest neighbours of that
+    color. Works on the four 2x2 sub-grids so only one padded copy of the
+    mosaic and the output plane are held in memory.
+
+    arguments
+    ---------
+    mosaic: 2D Numpy Array of raw Bayer values.
+    pattern: CFA pattern of the top-left 2x2 cell (string, ex. "BGGR").
+    index: Integer, 0,1,2 for R,G,B respectively
+
+    returns
+    -------
+    Numpy Array (float32)
+
+    """
+    color = "RGB"[index]
+    pattern = pattern.upper()
+    if len(pattern) != 4 or pattern.strip("RGB"):
+        raise ValueError("Not a 2x2 Bayer pattern: {0}".format(pattern))
+    ny, nx = mosaic.shape
+    # Reflect padding keeps the Bayer parity of the edge neighbours.
+    padded = np.pad(mosaic, 1, mode="reflect")
+    plane = mosaic.astype(np.float32)
+
+    for r0 in (0, 1):
+        for c0 in (0, 1):
+            if pattern[2 * r0 + c0] == color:
+                continue
+
+            def shifted(dy, dx):
+                return padded[1 + r0 + dy:1 + ny + dy:2,
+                              1 + c0 + dx:1 + nx + dx:2]
+
+            horizontal = pattern[2 * r0 + 1 - c0] == color
+            vertical = pattern[2 * (1 - r0) + c0] == color
+            if horizontal and vertical:
+                offsets = ((0, -1), (0, 1), (-1, 0), (1, 0))
+            elif horizontal:
+                offsets = ((0, -1), (0, 1))
+            elif vertical:
+                offsets = ((-1, 0), (1, 0))
+            else:
+                offsets = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+
+            total = np.zeros(plane[r0::2, c0::2].shape, dtype=np.float32)
+            for dy, dx in offsets:
+                total += shifted(dy, dx)
+            plane[r0::2, c0::2] = total / len(offsets)
+    return plane
+
+
+def superpixel(mosaic):
+    """
+    Half resolution luminance from a Bayer mosaic.
+
+    Sums every 2x2 CFA cell (one R, two G, one B pixel), so no
+    interpolation is involved and the counts are preserved.
+
+    arguments
+    ---------
+    mosaic: 2D Numpy Array of raw Bayer values.
+
+    returns
+    -------
+    Numpy Array (float32)
+
+    """
+    ny, nx = mosaic.shape[0] // 2 * 2, mosaic.shape[1] // 2 * 2
+    lum = mosaic[0:ny:2, 0:nx:2].astype(np.float32)
+    lum += mosaic[0:ny:2, 1:nx:2]
+    lum += mosaic[1:ny:2, 0:nx:2]
+    lum += mosaic[1:ny:2, 1:nx:2]
+    return lum
+
+
+def read_tiff_tags(filename):
+    """
+    Read the EXIF tags of a TIFF based RAW image (DNG, CR2, NEF...).
+
+    Parses IFD0, the EXIF sub-IFD and the DNG raw sub-IFDs in Python,
+    without running dcraw. Tags found in several keep the IFD0 value.
+
+    arguments
+    ---------
+    filename: input filename (string).
+
+    returns
+    -------
+    tags: dictionary of tag number (integer) to value. ASCII values are
+    strings, single numeric values are scalars, others are tuples.
+
+    """
+    sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8,
+             11: 4, 12: 8}
+    formats = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 11: 'f',
+               12: 'd'}
+    tags = {}
+    with open(filename, 'rb') as fh:
+        order = fh.read(2)
+        if order == b'II':
+            endian = '<'
+        elif order == b'MM':
+            endian = '>'
+        else:
+            raise ValueError("Not a TIFF based RAW file: %s" % filename)
+        magic, offset = struct.unpack(endian + 'HI', fh.read(6))
+        if magic != 42:
+            raise ValueError("Not a TIFF based RAW file: %s" % filename)
+
+        ifds = [offset]
+        while ifds:
+            fh.seek(ifds.pop(0))
+            count, = struct.unpack(endian + 'H', fh.read(2))
+            entries = fh.read(12 * count)
+            for i in range(count):
+                tag, typ, n, value = struct.unpack(
+                    endian + 'HHI4s', entries[12 * i:12 * i + 12])
+                if typ not in sizes or tag in tags:
+                    continue
+                size = sizes[typ] * n
+                if size > 4:
+                    here = fh.tell()
+                    fh.seek(struct.unpack(endian + 'I', value)[0])
+                    value = fh.read(size)
+                    fh.seek(here)
+                else:
+                    value = value[:size]
+                if typ == 2:
+                    value = value.split(b'\0')[0].decode('ascii', 'replace')
+                elif typ in (5, 10):
+                    ints = struct.unpack(
+                        endian + ('I' if typ == 5 else 'i') * 2 * n, value)
+                    value = tuple(a / float(b) if b else 0.0
+                                  for a, b in zip(ints[::2], ints[1::2]))
+                elif typ in formats:
+                    value = struct.unpack(endian + formats[typ] * n, value)
+                if isinstance(value, tuple) and len(value) == 1:
+                    value = value[0]
+                tags[tag] = value
+                # Follow the EXIF and raw sub-IFDs.
+                if tag == 0x8769:
+                    ifds.append(value)
+                elif tag == 0x014A:
+                    ifds.extend(value if isinstance(value, tuple)
+                                else (value,))
+    return tags
+
+
+# Next alternate index per output name, see _channel_destination.
+_sequence = {}
+_sequence_lock = threading.Lock()
+
+
+def _reserve(filename):
+    """Create filename exclusively; False if it already exists."""
+    try:
+        os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                         0o644))
+    except OSError:
+        if os.path.exists(filename):
+            return False
+        raise
+    return True
+
+
+def _next_index(stem):
+    """One past the highest existing '<stem>-<i>.fits' index."""
+    directory, name = os.path.split(stem)
+    pattern = re.compile(re.escape(name) + r"-(\d+)\.fits$")
+    last = 0
+    for entry in os.listdir(directory or "."):
+        m = pattern.match(entry)
+        if m:
+            last = max(last, int(m.group(1)))
+    return last + 1
+
+
 class cr2fits(object):
     """
     The main CR2FITS class.
@@ -274,6 +577,8 @@ class cr2fits(object):
         self.colorInput = color
         self.pbm_bytes = None
         self.colors = {0: "Red", 1: "Green", 2: "Blue", 3: "Raw"}
+        self.products = {"R": "Red", "G": "Green", "B": "Blue", "RAW": "Raw",
+                         "LUM": "Luminance"}
 
         self.date = None
         self.shutter = None
@@ -282,21 +587,85 @@ class cr2fits(object):
         self.focal = None
         self.original_file = None
         self.camera = None
+        self.pattern = None
 
         self.im_ppm = None
         self.im_channel = None
+        self._dcraw = None
 
-    def read_cr2(self):
-        """Run the dcraw command and read it as BytesIO."""
-        if self.colorInput == 3:
-            self.pbm_bytes = BytesIO(subprocess.check_output(["dcraw", "-D",
-                                                              "-4", "-j",
-                                                              "-c",
-                                                              self.filename]))
+    def read_cr2(self, raw=None):
+        """
+        Start the dcraw command and keep its output as a stream.
+
+        self.pbm_bytes is dcraw's stdout pipe; read_pbm parses the header
+        and reads the pixels straight from it, then checks dcraw's exit.
+        Decodes the unscaled raw mosaic if raw is True, or if raw is None
+        and the color index is 3. Call it after read_metadata, so an error
+        there never leaves dcraw blocked on a pipe nobody reads.
+        """
+        if raw is None:
+            raw = self.colorInput == 3
+        if raw:
+            args = ["dcraw", "-D", "-4", "-j", "-c", self.filename]
+        else:
+            args = ["dcraw", "-W", "-6", "-j", "-c", self.filename]
+        self._dcraw = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self.pbm_bytes = self._dcraw.stdout
+
+    def read_metadata(self):
+        """
+        Read the EXIF data from RAW image.
+
+        Parses the TIFF/EXIF tags in Python so dcraw runs only once per
+        file, for the pixels. Falls back to read_exif (dcraw -i -v) for
+        files that are not TIFF based.
+        """
+        try:
+            self.read_exif_tiff()
+        except (IOError, ValueError, struct.error):
+            self.read_exif()
+
+    def read_exif_tiff(self):
+        """Read the EXIF data from RAW image, formatted like dcraw -i -v."""
+        tags = read_tiff_tags(self.filename)
+
+        # Catching the Timestamp, the file time if there is none
+        stamp = tags.get(0x9003, tags.get(0x0132))
+        if stamp:
+            date = datetime.datetime.strptime(stamp.strip(),
+                                              '%Y:%m:%d %H:%M:%S')
         else:
-            self.pbm_bytes = BytesIO(subprocess.check_output(["dcraw", "-W",
-                                                              "-6", "-j", "-c",
-                                                              self.filename]))
+            date = datetime.datetime.fromtimestamp(
+                os.path.getmtime(self.filename))
+        self.date = '{0:%Y-%m-%d %H:%M:%S}'.format(date)
+
+        # Catching the Shutter Speed
+        shutter = float(tags.get(0x829A, 0))
+        if 0 < shutter < 1:
+            self.shutter = "1/{0:0.1f}".format(1 / shutter)
+        else:
+            self.shutter = "{0:0.1f}".format(shutter)
+
+        # Catching the Aperture, ISO Speed and Focal length
+        self.aperture = "{0:0.1f}".format(float(tags.get(0x829D, 0)))
+        iso = tags.get(0x8827, 0)
+        if isinstance(iso, tuple):
+            iso = iso[0]
+        self.iso = "{0:d}".format(int(iso))
+        self.focal = "{0:0.1f}".format(float(tags.get(0x920A, 0)))
+
+        # Catching the Original Filename of the cr2
+        self.original_file = self.filename
+
+        # Catching the Camera Type
+        self.camera = "{0} {1}".format(tags.get(0x010F, ""),
+                                       tags.get(0x0110, "")).strip()
+
+        # Catching the CFA pattern of a 2x2 Bayer filter
+        cfa = tags.get(0x828E)
+        if tags.get(0x828D) in (None, (2, 2)) and isinstance(cfa, tuple) \
+                and len(cfa) == 4:
+            self.pattern = "".join("RGB"[c] for c in cfa if c < 3)
 
     def read_exif(self):
         """Read the EXIT data from RAW image."""
@@ -354,6 +723,13 @@ class cr2fits(object):
         m = re.search('(?<=Camera:).*', cr2header)
         self.camera = m.group(0).strip()
 
+        # Catching the CFA pattern (first 2x2 cell), printed by dcraw
+        # one row per '/', ex. "RG/GB"
+        m = re.search('(?<=Filter pattern:).*', cr2header)
+        if m:
+            rows = m.group(0).strip().split('/')
+            self.pattern = "".join(r.strip()[:2] for r in rows[:2])
+
     def read_pbm(self, filename):
         """
         PBM to Numpy Array.
@@ -369,7 +745,18 @@ class cr2fits(object):
         Numpy Array
 
         """
-        return NetpbmFile(filename).asarray()
+        try:
+            return NetpbmFile(filename).asarray(copy=False)
+        finally:
+            if self._dcraw is not None and filename is self._dcraw.stdout:
+                self._finish_dcraw()
+
+    def _finish_dcraw(self):
+        """Close the dcraw pipe and raise if dcraw failed."""
+        proc, self._dcraw = self._dcraw, None
+        proc.stdout.close()
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
     def get_color(self, image, index):
         """
@@ -387,13 +774,14 @@ class cr2fits(object):
         """
         return image[:, :, index]
 
-    def create_fits(self, image):
+    def create_fits(self, image, filter_name=None):
         """
         Create FITS file from Numpy Array.
 
         arguments
         ---------
         image: Numpy Array
+        filter_name: FILTER keyword, defaults to the color of colorInput
 
         returns
         -------
@@ -407,7 +795,9 @@ class cr2fits(object):
         hdu.header.set('ISO', self.iso)
         hdu.header.set('FOCAL', self.focal)
         hdu.header.set('ORIGIN', self.original_file)
-        hdu.header.set('FILTER', self.colors[self.colorInput])
+        if filter_name is None:
+            filter_name = self.colors[self.colorInput]
+        hdu.header.set('FILTER', filter_name)
         hdu.header.set('CAMERA', self.camera)
         hdu.header.add_comment('FITS File Created with cr2fits.py\
                                available at {0}'.format(sourceweb))
@@ -438,18 +828,41 @@ class cr2fits(object):
             channel_name = "RAW"
         else:
             channel_name = self.colors[colorindex][0]
+        return self._channel_destination(filename, channel_name)
 
-        filename = "".join(filename.split('.')[:-1])
+    def _default_destination(self, filename, channel_name):
+        """Destination filename before any alternation (string)."""
+        filename = os.path.splitext(filename)[0]
+        return filename + "-" + channel_name + ".fits"
 
-        writename = filename + "-" + channel_name + ".fits"
-        if os.path.isfile(writename):
-            for i in range(1, 9000000):
-                # Crashes after 9million files with same name but what the hell
-                writename = "{fn}-{ch}-{i}.fits".format(fn=filename,
-                                                        ch=channel_name, i=i)
-                if not os.path.isfile(writename):
-                    break
-        return writename
+    def _channel_destination(self, filename, channel_name):
+        """
+        Generate destination filename for a channel name (string).
+
+        The name is reserved by creating an empty file exclusively, so two
+        writers never get the same name and write_fits fills it in. When
+        the default name is taken, alternate names come from a per-name
+        sequence counter that is seeded by one directory scan per process,
+        so naming stays constant time however many frames the directory
+        holds.
+        """
+        writename = self._default_destination(filename, channel_name)
+        stem = writename[:-len(".fits")]
+        key = os.path.abspath(stem)
+        with _sequence_lock:
+            if _reserve(writename):
+                # The counter is kept when the default name is free
+                # again, so a writer that deletes its previous frame
+                # (the guide loop) does not rescan every other frame.
+                return writename
+            if key not in _sequence:
+                _sequence[key] = _next_index(stem)
+            while True:
+                i = _sequence[key]
+                _sequence[key] = i + 1
+                writename = "{st}-{i}.fits".format(st=stem, i=i)
+                if _reserve(writename):
+                    return writename
 
     def write_fits(self, hdu, destination):
         """
@@ -459,18 +872,21 @@ class cr2fits(object):
         ---------
         hdu: FITS object
         destination: Filepath to write the FITS file to (string).
+        An empty file reserved by _generate_destination is overwritten.
 
         returns
         -------
         Void
 
         """
-        hdu.writeto(destination)
+        reserved = os.path.isfile(destination) and \
+            os.path.getsize(destination) == 0
+        hdu.writeto(destination, overwrite=reserved)
 
     def convert(self):
-        """Convert RAW to FITS."""
+        """Convert RAW to FITS and return the destination filename."""
+        self.read_metadata()
         self.read_cr2()
-        self.read_exif()
         im_ppm = self.read_pbm(self.pbm_bytes)
         if self.colorInput == 3:
             im_channel = im_ppm
@@ -479,10 +895,242 @@ class cr2fits(object):
         fits_image = self.create_fits(im_channel)
         dest = self._generate_destination(self.filename, self.colorInput)
         self.write_fits(fits_image, dest)
+        return dest
+
+    def get_products(self, mosaic, products, pattern=None):
+        """
+        Derive several products from one raw Bayer mosaic.
+
+        arguments
+        ---------
+        mosaic: 2D Numpy Array, the unscaled raw output of dcraw -D.
+        products: names from self.products: "R", "G", "B" (full
+        resolution color planes), "RAW" (the mosaic itself) and "LUM"
+        (half resolution 2x2 superpixel sum).
+        pattern: CFA pattern (string, ex. "RGGB"), defaults to the one
+        read from the EXIF data, or "RGGB".
+
+        returns
+        -------
+        Dictionary of product name to Numpy Array
+
+        """
+        pattern = pattern or self.pattern or "RGGB"
+        images = {}
+        for product in products:
+            if product == "RAW":
+                images[product] = mosaic
+            elif product == "LUM":
+                images[product] = superpixel(mosaic)
+            elif product in ("R", "G", "B"):
+                images[product] = demosaic(mosaic, pattern,
+                                           "RGB".index(product))
+            else:
+                raise ValueError("Unknown product: {0}".format(product))
+        return images
+
+    def convert_multi(self, products=("G", "RAW", "LUM"), mef=True,
+                      pattern=None):
+        """
+        Convert RAW to several FITS products with a single dcraw decode.
+
+        arguments
+        ---------
+        products: product names, see get_products.
+        mef: write one multi-extension FITS file with an extension per
+        product (EXTNAME is the product name) if True, otherwise a file
+        per product named like convert does.
+        pattern: CFA pattern, see get_products.
+
+        returns
+        -------
+        List of destination filenames
+
+        """
+        self.read_metadata()
+        self.read_cr2(raw=True)
+        mosaic = self.read_pbm(self.pbm_bytes)
+        images = self.get_products(mosaic, products, pattern)
+
+        if mef:
+            primary = self.create_fits(None, filter_name="Multi")
+            hdulist = fits.HDUList([primary])
+            for product in products:
+                hdu = fits.ImageHDU(images[product], name=product)
+                hdu.header.set('FILTER', self.products[product])
+                hdulist.append(hdu)
+            dest = self._channel_destination(self.filename, "MEF")
+            self.write_fits(hdulist, dest)
+            return [dest]
+
+        dests = []
+        for product in products:
+            hdu = self.create_fits(images[product],
+                                   filter_name=self.products[product])
+            dest = self._channel_destination(self.filename, product)
+            self.write_fits(hdu, dest)
+            dests.append(dest)
+        return dests
+
+
+RAW_EXTENSIONS = ('.dng', '.cr2', '.crw', '.nef', '.arw', '.orf', '.rw2',
+                  '.pef', '.raf')
+
+
+def find_raw_files(paths):
+    """
+    Expand files, glob patterns and directories into RAW filenames.
+
+    arguments
+    ---------
+    paths: list of filenames, glob patterns or directories (strings).
+    Directories are searched (not recursively) for RAW_EXTENSIONS.
+
+    returns
+    -------
+    Sorted list of unique filenames
+
+    """
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                if os.path.splitext(name)[1].lower() in RAW_EXTENSIONS:
+                    found.add(os.path.join(path, name))
+        else:
+            found.update(p for p in glob.glob(path) if os.path.isfile(p))
+    return sorted(found)
+
+
+def _convert_one(task):
+    """Convert one file of a batch; returns (status, filename, info)."""
+    filename, color, products, mef = task
+    cr2 = cr2fits(filename, color)
+    if products:
+        channels = ["MEF"] if mef else list(products)
+    else:
+        channels = ["RAW" if color == 3 else cr2.colors[color][0]]
+    outputs = [cr2._default_destination(filename, ch) for ch in channels]
+
+    # Skip files whose outputs are newer than the RAW file, replace
+    # stale outputs instead of writing alternate names next to them.
+    mtime = os.path.getmtime(filename)
+    if all(os.path.isfile(out) and os.path.getsize(out) > 0 and
+           os.path.getmtime(out) >= mtime for out in outputs):
+        return ("skipped", filename, None)
+    for out in outputs:
+        if os.path.isfile(out):
+            os.remove(out)
+
+    try:
+        if products:
+            cr2.convert_multi(products, mef)
+        else:
+            cr2.convert()
+    except Exception as err:
+        return ("failed", filename, str(err))
+    return ("converted", filename, os.path.getsize(filename))
+
+
+def batch_convert(paths, color=1, products=None, mef=True, jobs=None):
+    """
+    Convert many RAW files in parallel.
+
+    Each worker process runs one conversion (so one dcraw) at a time, so
+    at most 'jobs' dcraw processes are in flight. Files whose outputs are
+    up to date are skipped. Prints a throughput summary.
+
+    arguments
+    ---------
+    paths: filenames, glob patterns or directories, see find_raw_files.
+    color: color index used when products is None, see cr2fits.
+    products: product names for convert_multi, or None for convert.
+    Unknown product names raise ValueError before any file is decoded.
+    mef: passed to convert_multi.
+    jobs: number of worker processes, defaults to the number of CPUs.
+
+    returns
+    -------
+    Dictionary of status ("converted", "skipped", "failed") to filenames
+
+    """
+    if products:
+        names = cr2fits(None, color).products
+        unknown = [p for p in products if p not in names]
+        if unknown:
+            raise ValueError("Unknown product: {0}".format(",".join(unknown)))
+    files = find_raw_files(paths)
+    results = {"converted": [], "skipped": [], "failed": []}
+    nbytes = 0
+    start = time.time()
+    tasks = [(f, color, products, mef) for f in files]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for status, filename, info in pool.map(_convert_one, tasks):
+            results[status].append(filename)
+            if status == "failed":
+                print("ERROR: {0}: {1}".format(filename, info))
+            elif status == "converted":
+                nbytes += info
+    elapsed = time.time() - start
+
+    converted = len(results["converted"])
+    print("Converted {0}, skipped {1}, failed {2} of {3} files in "
+          "{4:.1f} s ({5:.2f} files/s, {6:.1f} MB/s)".format(
+              converted, len(results["skipped"]), len(results["failed"]),
+              len(files), elapsed, converted / elapsed if elapsed else 0.0,
+              nbytes / 1e6 / elapsed if elapsed else 0.0))
+    return results
 
 
 if __name__ == '__main__':
 
+    if sys.version_info[0] > 2:
+        # A nasty hack to work around Python 3 compatilibity
+        basestring = str
+
+        def unicode(x):
+            """Dirty hack for Python 3."""
+            return str(x, 'ascii')
+
+    colors = {0: "Red", 1: "Green", 2: "Blue", 3: "Raw"}
+
+    if sys.argv[1:2] == ['--batch']:
+        args = sys.argv[2:]
+        try:
+            jobs = None
+            if '-j' in args:
+                i = args.index('-j')
+                jobs = int(args[i + 1])
+                del args[i:i + 2]
+            products = None
+            if '-p' in args:
+                i = args.index('-p')
+                products = args[i + 1].upper().split(',')
+                del args[i:i + 2]
+            # The color index is optional with -p.
+            colorInput = 1
+            if not products or (len(args) > 1 and args[0].isdigit()):
+                colorInput = int(args[0])
+                del args[0]
+            paths = args
+            if not paths or colorInput not in colors:
+                raise ValueError
+        except (ValueError, IndexError):
+            print("./cr2fits.py --batch [-j jobs] [-p products] "
+                  "[<color-index>] <files, globs or directories>")
+            print("Converts every RAW file across 'jobs' processes, "
+                  "skipping files whose FITS output is up to date.")
+            print("-p writes a multi-extension FITS of comma separated "
+                  "products from R,G,B,RAW,LUM instead of one channel;")
+            print("the color index is then optional.")
+            print("Example:\n\t$ ./cr2fits.py --batch -j 4 1 night1/")
+            raise SystemExit
+        try:
+            batch_convert(paths, colorInput, products, jobs=jobs)
+        except ValueError as err:
+            print("ERROR: {0}".format(err))
+        raise SystemExit
+
     try:
         cr2FileName = sys.argv[1]
         colorInput = int(sys.argv[2])
@@ -494,19 +1142,11 @@ if __name__ == '__main__':
         print("The above example will create a fits file.")
         print("\tmyimage-G.fits: The FITS image in the Green channel, \
               which is the purpose!")
+        print("For batch conversion: ./cr2fits.py --batch")
         print("For details: {0}".format(sourceweb))
         print("Version: {0}".format(__version__))
         raise SystemExit
 
-    if sys.version_info[0] > 2:
-        # A nasty hack to work around Python 3 compatilibity
-        basestring = str
-
-        def unicode(x):
-            """Dirty hack for Python 3."""
-            return str(x, 'ascii')
-
-    colors = {0: "Red", 1: "Green", 2: "Blue", 3: "Raw"}
     colorState = any([True for i in colors.keys() if i == colorInput])
     if not colorState:
         print("ERROR: Color value can be set as 0:Red, 1:Green, 2:Blue, 3:Raw")
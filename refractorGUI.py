@@ -55,9 +55,18 @@ class Ui_MainWindow(object):
         spacerItem = QtWidgets.QSpacerItem(40, 20, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum)
         self.horizontalLayout_3.addItem(spacerItem)
         self.verticalLayout_2.addLayout(self.horizontalLayout_3)
+        self.horizontalLayout_4 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_4.setObjectName("horizontalLayout_4")
         self.centroidButton = QtWidgets.QPushButton(self.centralwidget)
         self.centroidButton.setObjectName("centroidButton")
-        self.verticalLayout_2.addWidget(self.centroidButton)
+        self.horizontalLayout_4.addWidget(self.centroidButton)
+        self.autoCentroidBox = QtWidgets.QCheckBox(self.centralwidget)
+        self.autoCentroidBox.setObjectName("autoCentroidBox")
+        self.horizontalLayout_4.addWidget(self.autoCentroidBox)
+        self.guideBox = QtWidgets.QCheckBox(self.centralwidget)
+        self.guideBox.setObjectName("guideBox")
+        self.horizontalLayout_4.addWidget(self.guideBox)
+        self.verticalLayout_2.addLayout(self.horizontalLayout_4)
         self.gridLayout_2.addLayout(self.verticalLayout_2, 2, 0, 1, 1)
         self.textEdit = QtWidgets.QTextEdit(self.centralwidget)
         self.textEdit.setReadOnly(True)
@@ -87,6 +96,8 @@ class Ui_MainWindow(object):
         self.lineEdit_2.setText(_translate("MainWindow", "# Exps"))
         self.lineEdit.setText(_translate("MainWindow", " Exp time (s)"))
         self.centroidButton.setText(_translate("MainWindow", "Centroid and offset"))
+        self.autoCentroidBox.setText(_translate("MainWindow", "Auto"))
+        self.guideBox.setText(_translate("MainWindow", "Guide"))
         self.refractorBox.setTitle(_translate("MainWindow", "Refractor Cover:"))
         self.openButton.setText(_translate("MainWindow", "Open"))
         self.closeButton.setText(_translate("MainWindow", "Close"))
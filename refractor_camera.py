@@ -1,68 +1,366 @@
-import sys, picamera, os
-from pydng.core import RPICAM2DNG
-from cr2fits import cr2fits
+import sys, os, io, json, time, tempfile, itertools
+import numpy as np
+from multiprocessing.connection import Listener, Client
+from cr2fits import cr2fits, demosaic
 from time import sleep
 from fractions import Fraction
 
-class Refractor():
-	def __init__(self):
-		super().__init__()
+# Local socket the persistent camera worker listens on.
+ADDRESS = '/tmp/refractor_camera.sock'
+AUTHKEY = b'fhire-refractor'
+# Raw captures handed from the worker to the GUI for conversion. Kept
+# in RAM (tmpfs) when available instead of on the SD card.
+RAW_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
 
-		#_stderr = sys.stderr
-		#_stdout = sys.stdout
-		#null = open(os.devnull, 'wb')
-		#sys.stderr = sys.stdout = null
+# Raw Bayer block that picamera appends to a jpeg with bayer=True:
+# (width, height, bits per pixel, CFA pattern) per sensor. The block is
+# a 32768 byte 'BRCM' header followed by rows padded to 32 bytes.
+BAYER_SENSORS = {
+	'imx477': (4056, 3040, 12, 'BGGR'),  # RPi HQ camera
+	'imx219': (3280, 2464, 10, 'BGGR'),  # RPi camera v2
+	'ov5647': (2592, 1944, 10, 'GBRG'),  # RPi camera v1
+}
+# Byte size of the whole block per sensor, as in picamera. The padding
+# of the row count differs per sensor, so it is not computed.
+BAYER_SIZES = {
+	'imx477': 18711040,
+	'imx219': 10270208,
+	'ov5647': 6404096,
+}
+BAYER_HEADER = 32768
+
+# Row stride, padded row count and byte size of the raw Bayer block of
+# a sensor.
+def _bayer_layout(sensor):
+	width, height, bits, pattern = BAYER_SENSORS[sensor]
+	stride = (width * bits // 8 + 31) // 32 * 32
+	size = BAYER_SIZES[sensor]
+	return stride, (size - BAYER_HEADER) // stride, size
+
+# Finds the raw Bayer block at the end of a picamera capture. Returns
+# (sensor, offset of the block).
+def _find_bayer(data):
+	for sensor in BAYER_SENSORS:
+		stride, rows, size = _bayer_layout(sensor)
+		if len(data) >= size and \
+		   bytes(data[len(data) - size:len(data) - size + 4]) == b'BRCM':
+			return sensor, len(data) - size
+	raise ValueError("No raw Bayer data found in capture.")
+
+# Returns only the raw Bayer block of a capture, without the jpeg.
+def raw_block(data):
+	data = memoryview(data)
+	sensor, offset = _find_bayer(data)
+	return data[offset:]
+
+# Unpacks the raw Bayer block at the end of a picamera jpeg capture
+# straight into a uint16 mosaic. Returns (mosaic, pattern).
+def unpack_bayer(data):
+	data = memoryview(data)
+	sensor, offset = _find_bayer(data)
+	width, height, bits, pattern = BAYER_SENSORS[sensor]
+	stride, rows, size = _bayer_layout(sensor)
+
+	raw = np.frombuffer(data[offset + BAYER_HEADER:],
+			    dtype=np.uint8).reshape(rows, stride)
+	raw = raw[:height, :width * bits // 8]
+	if bits == 12:
+		# 2 pixels in 3 bytes: high bytes, then both low nibbles.
+		raw = raw.reshape(height, width // 2, 3).astype(np.uint16)
+		mosaic = np.empty((height, width), dtype=np.uint16)
+		mosaic[:, 0::2] = (raw[:, :, 0] << 4) | (raw[:, :, 2] & 0x0F)
+		mosaic[:, 1::2] = (raw[:, :, 1] << 4) | (raw[:, :, 2] >> 4)
+	else:
+		# 4 pixels in 5 bytes: high bytes, then the four low 2 bits.
+		raw = raw.reshape(height, width // 4, 5).astype(np.uint16)
+		mosaic = np.empty((height, width), dtype=np.uint16)
+		for i in range(4):
+			mosaic[:, i::4] = (raw[:, :, i] << 2) | \
+					  ((raw[:, :, 4] >> (2 * i)) & 0x03)
+	return mosaic, pattern
+
+# Unpacks the raw Bayer data and writes the green channel straight to
+# fits. Pixel values are raw sensor counts. Returns the fits path.
+def bayer2fits(data, img, expTime, iso, camera, date=None):
+	mosaic, pattern = unpack_bayer(data)
+	green = demosaic(mosaic, pattern, 1)
+	green = np.round(green).astype(np.uint16)
 
-	def take_exposure(self, expTime):
-		fname = 'RefractorImage_temp'
-		time = int(expTime) * 1000000  # time in microSec
+	# Reuse cr2fits for the header layout and file naming.
+	fitsConvert = cr2fits(img + '.jpg', 1)
+	fitsConvert.date = time.strftime('%Y-%m-%d %H:%M:%S',
+					 time.localtime(date))
+	fitsConvert.shutter = str(expTime)
+	fitsConvert.iso = str(iso)
+	fitsConvert.original_file = img + '.jpg'
+	fitsConvert.camera = camera
+	hdu = fitsConvert.create_fits(green)
+	dest = fitsConvert._generate_destination(fitsConvert.filename, 1)
+	fitsConvert.write_fits(hdu, dest)
+	return dest
 
-		# Taking img with picamera (max exposure time for HQ 
+# RPi HQ camera, opened once and kept open with fixed gains and AWB.
+class PiCameraBackend():
+	def __init__(self, iso=800):
+		import picamera
+
+		# Taking img with picamera (max exposure time for HQ
 		# cam is 200s).
-		# TO DO: Test camera settings when at WIRO. Use for 
-		# dark exposures? 
+		# TO DO: Test camera settings when at WIRO. Use for
+		# dark exposures?
 		#self.camera = picamera.PiCamera(
 		#	framerate=Fraction(1, 6), sensor_mode=3)
 
-		self.camera = picamera.PiCamera()		
-		self.camera.iso = 800
+		self.camera = picamera.PiCamera()
+		self.camera.iso = iso
+		self.iso = iso
+		self.name = 'RPi ' + self.camera.revision
 		#self.camera.brightness = 80
 		#self.camera.contrast = 100
-		# Give camera time to set gains and measure AWB 
-		# (might want to use fixed AWB instead).
+		# Give camera time to set gains and measure AWB once,
+		# then fix them for every following exposure.
 		sleep(2)
-		self.camera.shutter_speed = time
 		self.camera.exposure_mode = 'off'
-		# Fixes white balance gains (AWB). Dont know if it 
-		# is necessary.
 		g = self.camera.awb_gains
 		self.camera.awb_mode = 'off'
 		self.camera.awb_gains = g
-		self.camera.capture(fname + ".jpg", format='jpeg', bayer=True)
+
+	# Captures a jpg with the Bayer data appended and returns its
+	# bytes.
+	def capture(self, expTime):
+		self.camera.shutter_speed = int(float(expTime) * 1000000)
+		stream = io.BytesIO()
+		self.camera.capture(stream, format='jpeg', bayer=True)
+		return stream.getbuffer()
+
+	def close(self):
+		self.camera.close()
+
+# Stand-in camera for testing without the RPi HQ camera. Returns a
+# synthetic star field packed like the HQ camera's raw Bayer block.
+class SimCameraBackend():
+	def __init__(self, stars=((3800, 1690, 3000),), sky=200., noise=10.,
+		     seed=None):
+		self.stars = stars
+		self.sky = sky
+		self.noise = noise
+		self.iso = 800
+		self.name = 'Simulated imx477'
+		self.rng = np.random.RandomState(seed)
+
+	def capture(self, expTime):
+		width, height, bits, pattern = BAYER_SENSORS['imx477']
+		image = self.rng.normal(self.sky, self.noise, (height, width))
+		for (x, y, peak) in self.stars:
+			x1, x2 = max(int(x) - 15, 0), min(int(x) + 16, width)
+			y1, y2 = max(int(y) - 15, 0), min(int(y) + 16, height)
+			yy, xx = np.mgrid[y1:y2, x1:x2]
+			image[y1:y2, x1:x2] += peak * np.exp(
+				-((xx + 1 - x)**2 + (yy + 1 - y)**2) / 18.)
+		mosaic = np.clip(image, 0, 4095).astype(np.uint16)
+
+		# Pack 2 pixels in 3 bytes behind a 'BRCM' header.
+		stride, rows, size = _bayer_layout('imx477')
+		raw = np.zeros((rows, stride), dtype=np.uint8)
+		packed = raw[:height, :width * 3 // 2].reshape(
+						height, width // 2, 3)
+		packed[:, :, 0] = mosaic[:, 0::2] >> 4
+		packed[:, :, 1] = mosaic[:, 1::2] >> 4
+		packed[:, :, 2] = (mosaic[:, 0::2] & 0x0F) | \
+				  ((mosaic[:, 1::2] & 0x0F) << 4)
+		header = b'BRCM'.ljust(BAYER_HEADER, b'\0')
+		return b'\xff\xd8' + header + raw.tobytes()
+
+	def close(self):
+		pass
+
+class Refractor():
+	def __init__(self, backend=None, native=True):
+		super().__init__()
+		self.backend = backend if backend is not None \
+				else PiCameraBackend()
+		# Decode the raw Bayer data in memory instead of going
+		# through dng and dcraw.
+		self.native = native
+
+		#_stderr = sys.stderr
+		#_stdout = sys.stdout
+		#null = open(os.devnull, 'wb')
+		#sys.stderr = sys.stdout = null
+
+	# Takes an exposure and returns the path of the FITS file.
+	def take_exposure(self, expTime, fname='RefractorImage_temp'):
+		data = self.backend.capture(expTime)
 
 		print("Exposure complete.")
 
-		self.convert2fits(fname)
+		if self.native:
+			return self.bayer2fits(data, fname, expTime)
+
+		with open(fname + '.jpg', 'wb') as f:
+			f.write(data)
+		return self.convert2fits(fname)
+
+	# Unpacks the raw Bayer data and writes the green channel
+	# straight to fits.
+	def bayer2fits(self, data, img, expTime):
+		return bayer2fits(data, img, expTime, self.backend.iso,
+				  self.backend.name)
+
+	# Takes an exposure and saves only its raw Bayer block to path,
+	# so conversion can run elsewhere while the next frame exposes.
+	# Returns what the converter needs besides the pixels.
+	def capture_raw(self, expTime, path):
+		data = self.backend.capture(expTime)
+		end = time.time()
+		with open(path, 'wb') as f:
+			f.write(raw_block(data))
+		return {'path': path, 'time': expTime, 'end': end,
+			'iso': self.backend.iso, 'camera': self.backend.name}
 
 	# Converts to a raw image (dng), then converts raw to fits.
 	def convert2fits(self,img):
-	
+		from pydng.core import RPICAM2DNG
+
 		print("Converting to fits.")
-		
+
 		img_jpg = img + '.jpg'
 		rawConvert = RPICAM2DNG()
 		rawConvert.convert(img_jpg)
 
 		img_raw = img + '.dng'
 		img_fits = img + '.fits'
-		# color-index can take one of four values, either 0, 1, 
-		# 2, 3. Represent Red, Green, Blue and Unscaled 
+		# color-index can take one of four values, either 0, 1,
+		# 2, 3. Represent Red, Green, Blue and Unscaled
 		# Raw respectively.
 		fitsConvert = cr2fits(img_raw, 1)
-		fitsConvert.convert()
-		
+		dest = fitsConvert.convert()
+
 		print("Conversion complete.")
+		return dest
+
+	def close(self):
+		self.backend.close()
+
+#
+# Long-lived camera worker. Keeps one camera open and takes exposure
+# requests as JSON messages over a local socket, so a sequence does not
+# pay for a new interpreter and camera warm-up on every frame.
+#
+def serve(refract, address=ADDRESS):
+	if os.path.exists(address):
+		os.remove(address)
+	listener = Listener(address, family='AF_UNIX', authkey=AUTHKEY)
+	print("Camera worker listening on %s." %address)
+	running = True
+	try:
+		while running:
+			conn = listener.accept()
+			running = _handle(refract, conn)
+			conn.close()
+	finally:
+		listener.close()
+		refract.close()
+
+# Numbers the raw capture files of this worker.
+_captures = itertools.count()
+
+# Answers requests on one connection. Returns False on 'quit'.
+def _handle(refract, conn):
+	while True:
+		try:
+			request = json.loads(conn.recv_bytes().decode('utf-8'))
+		except EOFError:
+			return True
+		cmd = request.get('cmd')
+		if cmd == 'quit':
+			conn.send_bytes(json.dumps({'ok': True}).encode('utf-8'))
+			return False
+		start = time.time()
+		try:
+			if cmd == 'expose':
+				path = refract.take_exposure(
+					request['time'],
+					request.get('fname', 'RefractorImage_temp'))
+				reply = {'ok': True, 'path': path}
+			elif cmd == 'capture':
+				path = request.get('path') or os.path.join(
+					RAW_DIR, 'refractor_raw_%d_%d.bin' %(
+						os.getpid(), next(_captures)))
+				reply = refract.capture_raw(request['time'], path)
+				reply['ok'] = True
+			elif cmd == 'ping':
+				reply = {'ok': True}
+			else:
+				reply = {'ok': False,
+					 'error': 'Unknown command %s' %cmd}
+		except Exception as err:
+			reply = {'ok': False, 'error': str(err)}
+		reply['elapsed'] = time.time() - start
+		conn.send_bytes(json.dumps(reply).encode('utf-8'))
+
+# Converts a raw capture made by the 'capture' command to fits and
+# deletes the raw file. Returns the fits path.
+def convert_capture(capture, img='RefractorImage_temp'):
+	data = np.fromfile(capture['path'], dtype=np.uint8)
+	os.remove(capture['path'])
+	return bayer2fits(data, img, capture['time'], capture['iso'],
+			  capture['camera'], capture['end'])
+
+# Deletes a raw capture that will not be converted.
+def discard_capture(capture):
+	try:
+		os.remove(capture['path'])
+	except FileNotFoundError:
+		pass
+
+# Client side of the camera worker, used by the GUI.
+class CameraClient():
+	def __init__(self, address=ADDRESS, timeout=30.):
+		# Wait for the worker to open its socket.
+		start = time.time()
+		while True:
+			try:
+				self.conn = Client(address, family='AF_UNIX',
+						   authkey=AUTHKEY)
+				break
+			except (FileNotFoundError, ConnectionRefusedError):
+				if time.time() - start > timeout:
+					raise
+				sleep(0.1)
+
+	def request(self, **request):
+		self.conn.send_bytes(json.dumps(request).encode('utf-8'))
+		reply = json.loads(self.conn.recv_bytes().decode('utf-8'))
+		if not reply['ok']:
+			raise RuntimeError(reply['error'])
+		return reply
+
+	# Takes an exposure and returns the path of the FITS file.
+	def expose(self, expTime, fname='RefractorImage_temp'):
+		return self.request(cmd='expose', time=expTime,
+				    fname=fname)['path']
+
+	# Takes an exposure without converting it. Returns a dict with
+	# the raw file 'path' and the 'time', 'end', 'iso' and 'camera'
+	# to pass to convert_capture.
+	def capture(self, expTime):
+		return self.request(cmd='capture', time=expTime)
+
+	# Stops the worker and closes the connection.
+	def shutdown(self):
+		try:
+			self.request(cmd='quit')
+		finally:
+			self.conn.close()
 
-if __name__ == '__main__': 
-	refract = Refractor()
-	refract.take_exposure(sys.argv[1])
+if __name__ == '__main__':
+	# '--sim' uses the stand-in camera, '--dng' the old
+	# jpg -> dng -> dcraw conversion.
+	backend = SimCameraBackend() if '--sim' in sys.argv else None
+	refract = Refractor(backend, native='--dng' not in sys.argv)
+	if sys.argv[1] == '--serve':
+		serve(refract)
+	else:
+		refract.take_exposure(sys.argv[1])
+		refract.close()
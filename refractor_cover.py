@@ -0,0 +1,63 @@
+import os, json, time, tempfile
+
+#
+# Last known refractor cover position, kept in a small JSON file so a
+# restarted GUI can trust it instead of sweeping the cover home. The
+# file is rewritten atomically (temporary file + rename) at the start
+# and end of every move; a move that never ended leaves the state
+# 'moving', which is never trusted.
+#
+class CoverState():
+	def __init__(self, path):
+		self.path = os.path.expanduser(path)
+
+	# Returns the stored state as a dict, or None if there is none
+	# or it cannot be read.
+	def load(self):
+		try:
+			with open(self.path) as f:
+				state = json.load(f)
+		except (OSError, ValueError):
+			return None
+		if not isinstance(state, dict) or \
+		   not isinstance(state.get('position'), int) or \
+		   state.get('state') not in ('open', 'closed', 'partial',
+					      'moving'):
+			return None
+		return state
+
+	def save(self, position, state):
+		data = {'position': int(position), 'state': state,
+			'time': time.time()}
+		folder = os.path.dirname(self.path) or '.'
+		(fd, tmp) = tempfile.mkstemp(dir=folder, prefix='.cover-')
+		try:
+			with os.fdopen(fd, 'w') as f:
+				json.dump(data, f)
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(tmp, self.path)
+		except BaseException:
+			os.remove(tmp)
+			raise
+
+	def clear(self):
+		try:
+			os.remove(self.path)
+		except FileNotFoundError:
+			pass
+
+# Names the cover state of a motor position.
+def cover_state(position, duration):
+	if position <= 0:
+		return 'closed'
+	if position >= duration:
+		return 'open'
+	return 'partial'
+
+# Checks a stored state against one reading of the home switch. The
+# switch is closed only with the cover at (or just past) home.
+def consistent(state, home):
+	if state is None or state['state'] == 'moving':
+		return False
+	return (state['state'] == 'closed') == home
@@ -0,0 +1,260 @@
+import time, threading
+from collections import deque
+import numpy as np
+from astropy.io import fits
+from FindStars import _downsample
+from ReadRegions import Box
+
+try:
+	import pyds9
+	ds9_loaded = True
+except ImportError:
+	ds9_loaded = False
+
+# Raised for a DS9 that cannot be reached or rejects a command.
+class DS9Error(Exception):
+	pass
+
+#
+# One XPA connection to DS9 kept for the life of the GUI, instead of a
+# new xpaset process per command. Every command is timed; latency()
+# and summary() report the recent round trips per command keyword.
+#
+# XPA takes one command per access point call, so batch() cannot send
+# several commands in one message. It runs them back to back over the
+# open connection and merges consecutive region commands, which DS9
+# accepts separated by ';', into a single call where it is safe.
+#
+class DS9Session():
+	def __init__(self, target='ds9', history=100):
+		self.target = target
+		self.ds9 = None
+		self.times = {}
+		self.history = history
+		self.lock = threading.RLock()
+
+	# Opens DS9, or attaches to the running one, on first use.
+	def connect(self):
+		with self.lock:
+			if self.ds9 is None:
+				if not ds9_loaded:
+					raise DS9Error("pyds9 is not installed")
+				try:
+					self.ds9 = pyds9.DS9(self.target)
+				except (ValueError, OSError) as err:
+					raise DS9Error(str(err))
+			return self.ds9
+
+	def connected(self):
+		return self.ds9 is not None
+
+	# Sends one xpaset command, e.g. 'zoom to fit'. data is sent
+	# as the command's payload (e.g. array bytes).
+	def set(self, cmd, data=None):
+		return self._call('set', cmd, data)
+
+	# Sends one xpaget command and returns the reply string.
+	def get(self, cmd):
+		return self._call('get', cmd, None)
+
+	# Runs a list of xpaset commands over the open connection.
+	# Returns the time taken per command sent.
+	def batch(self, commands):
+		calls = []
+		regions = []
+		for cmd in commands:
+			if cmd.startswith('regions command '):
+				regions.append(cmd[len('regions command '):])
+				# Properties after '#' run to the end of
+				# the line, so nothing may follow them.
+				if '#' in cmd:
+					calls.append(_region_command(regions))
+					regions = []
+				continue
+			if regions:
+				calls.append(_region_command(regions))
+				regions = []
+			calls.append(cmd)
+		if regions:
+			calls.append(_region_command(regions))
+
+		elapsed = []
+		for cmd in calls:
+			start = time.time()
+			self.set(cmd)
+			elapsed.append((cmd, time.time() - start))
+		return elapsed
+
+	# Shows an image array in DS9 straight from memory, without a
+	# FITS file on disk, then runs the display commands. With factor
+	# > 1 the image is block-averaged first and sent with LTM/LTV
+	# keywords, so DS9 physical coordinates (and saved regions) stay
+	# in full resolution pixels.
+	def show(self, data, factor=1, commands=('zoom to fit', 'zscale')):
+		start = time.time()
+		if factor > 1:
+			small = _downsample(data, factor)
+			hdu = fits.PrimaryHDU(small)
+			for axis in (1, 2):
+				hdu.header['LTM%d_%d' %(axis, axis)] = 1./factor
+				hdu.header['LTV%d' %axis] = 0.5 - 0.5/factor
+			self._call('set_pyfits', 'fits',
+				   fits.HDUList([hdu]))
+		else:
+			self._call('set_np2arr', 'array', np.asarray(data))
+		return [('show', time.time() - start)] + \
+		       self.batch(commands)
+
+	# Mean and max latency in ms and count per command keyword.
+	def latency(self):
+		with self.lock:
+			return {key: (1e3*sum(t)/len(t), 1e3*max(t), len(t))
+				for key, t in self.times.items()}
+
+	def summary(self):
+		for key, (mean, most, n) in sorted(self.latency().items()):
+			print("> ds9 %-10s %7.1f ms mean %7.1f ms max (%s)" %(
+						key, mean, most, n))
+
+	def _call(self, kind, cmd, data):
+		with self.lock:
+			ds9 = self.connect()
+			start = time.time()
+			try:
+				if kind == 'get':
+					result = ds9.get(cmd)
+				elif kind == 'set_np2arr':
+					result = ds9.set_np2arr(data)
+				elif kind == 'set_pyfits':
+					result = ds9.set_pyfits(data)
+				elif data is None:
+					result = ds9.set(cmd)
+				else:
+					result = ds9.set(cmd, data)
+			except (ValueError, OSError) as err:
+				# DS9 may have been closed; reconnect next time.
+				self.ds9 = None
+				raise DS9Error("%s %s: %s" %(kind, cmd, err))
+			key = cmd.split(' ', 1)[0]
+			self.times.setdefault(key, deque(maxlen=self.history))
+			self.times[key].append(time.time() - start)
+			return result
+
+#
+# Calls back when DS9 regions are created or moved. XPA has no push
+# notification of region edits, so the regions are polled over the open
+# connection and diffed. A region is reported once it has stayed put for
+# one poll, so a box being dragged fires once when it is dropped, not on
+# every step of the drag. Regions present at start() are not reported.
+#
+#   fetch() -> regions       current regions (ReadRegions types), or
+#                            None when DS9 cannot be read
+#   callback(region)         called from the watcher thread
+#
+class RegionWatcher():
+	def __init__(self, fetch, callback, interval=0.5, shapes=(Box,)):
+		self.fetch = fetch
+		self.callback = callback
+		self.interval = interval
+		self.shapes = shapes
+		self.previous = set()
+		self.reported = set()
+		self.thread = None
+		self.halt = threading.Event()
+
+	def start(self):
+		if self.running():
+			return
+		self.prime()
+		self.halt.clear()
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		self.halt.set()
+
+	def running(self):
+		return self.thread is not None and self.thread.is_alive() and \
+		       not self.halt.is_set()
+
+	def run(self):
+		while not self.halt.wait(self.interval):
+			try:
+				self.poll()
+			except Exception as err:
+				print("> ERROR: Region watch failed. %s" %err)
+
+	# Takes the current regions as already reported.
+	def prime(self):
+		current = self._current()
+		if current is not None:
+			self.previous = set(current)
+			self.reported = set(current)
+
+	# Runs one poll and returns the regions reported.
+	def poll(self):
+		current = self._current()
+		if current is None:
+			return []
+		stable = set(current) & self.previous
+		new = [current[key] for key in sorted(stable - self.reported)]
+		self.reported = stable | (self.reported & set(current))
+		self.previous = set(current)
+		for region in new:
+			self.callback(region)
+		return new
+
+	# Current regions keyed by shape and position.
+	def _current(self):
+		regions = self.fetch()
+		if regions is None:
+			return None
+		return {_region_key(r): r for r in regions
+			if isinstance(r, self.shapes)}
+
+#
+# Local stand-in for DS9 regions, for running the region watcher and
+# centroiding without DS9. Answers the 'regions' get and the 'regions
+# command' and 'regions delete all' sets of DS9Session.
+#
+class LocalRegions():
+	def __init__(self):
+		self.lines = []
+		self.lock = threading.Lock()
+
+	def connected(self):
+		return True
+
+	def get(self, cmd):
+		with self.lock:
+			return '\n'.join(['physical'] + self.lines) + '\n'
+
+	def set(self, cmd, data=None):
+		with self.lock:
+			if cmd.startswith('regions command '):
+				text = cmd[len('regions command '):].strip()
+				self.lines.append(text.strip('{}'))
+			elif cmd == 'regions delete all':
+				self.lines = []
+			return 1
+
+	# Replaces a region line, e.g. to move a box.
+	def replace(self, old, new):
+		with self.lock:
+			self.lines[self.lines.index(old)] = new
+
+# Identifies a region by its type and position to 0.1 pixel.
+def _region_key(region):
+	values = []
+	for v in region[:-2]:
+		if isinstance(v, list):
+			values.extend(c for point in v for c in point)
+		else:
+			values.append(v)
+	return (type(region).__name__,) + tuple(round(v, 1) for v in values)
+
+# Joins region strings into one 'regions command'.
+def _region_command(regions):
+	return 'regions command {%s}' %'; '.join(
+		r.strip().strip('{}') for r in regions)
@@ -0,0 +1,154 @@
+import sys, threading
+
+#
+# GPIO layer of the refractor cover. Exposes the RPi.GPIO calls used by
+# the switch and motor classes as 'GPIO': the real RPi.GPIO module on
+# the Pi, or SimGPIO when run with --sim or where RPi.GPIO is not
+# installed, so the GUI, motor and homing run headless.
+#
+
+# Pins of the cover hardware (BCM numbering).
+PUL = 17
+DIR = 27
+ENA = 22
+SWITCH_OUT = 20
+SWITCH_IN = 19
+
+#
+# Deterministic stand-in for RPi.GPIO. Keeps the level and mode of
+# every pin and calls edge callbacks synchronously, in the thread that
+# changed the level, when an input changes. Inputs are driven from
+# outside with set_input(), e.g. by SimCover.
+#
+class SimGPIO():
+	BCM = 11
+	BOARD = 10
+	OUT = 0
+	IN = 1
+	LOW = 0
+	HIGH = 1
+	PUD_OFF = 20
+	PUD_DOWN = 21
+	PUD_UP = 22
+	RISING = 31
+	FALLING = 32
+	BOTH = 33
+
+	def __init__(self):
+		self.mode = None
+		self.modes = {}
+		self.levels = {}
+		self.callbacks = {}
+		# Number of output writes per pin.
+		self.writes = {}
+		self.cover = None
+		self.lock = threading.RLock()
+
+	def setmode(self, mode):
+		self.mode = mode
+
+	def setwarnings(self, flag):
+		pass
+
+	def setup(self, pin, mode, pull_up_down=None, initial=None):
+		with self.lock:
+			self.modes[pin] = mode
+			if mode == self.IN:
+				level = 1 if pull_up_down == self.PUD_UP else 0
+				self.levels.setdefault(pin, level)
+			else:
+				self.levels[pin] = initial or 0
+
+	def output(self, pin, level):
+		if self.modes.get(pin) != self.OUT:
+			raise RuntimeError("GPIO %s is not set up as an " \
+					   "output" %pin)
+		with self.lock:
+			self.levels[pin] = int(bool(level))
+			self.writes[pin] = self.writes.get(pin, 0) + 1
+		if self.cover is not None:
+			self.cover.pin_changed(pin, int(bool(level)))
+
+	def input(self, pin):
+		if pin not in self.modes:
+			raise RuntimeError("GPIO %s is not set up" %pin)
+		return self.levels.get(pin, 0)
+
+	def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+		if pin in self.callbacks:
+			raise RuntimeError("Edge detection already enabled " \
+					   "for GPIO %s" %pin)
+		self.callbacks[pin] = (edge, callback)
+
+	def remove_event_detect(self, pin):
+		self.callbacks.pop(pin, None)
+
+	def cleanup(self):
+		self.modes = {}
+		self.levels = {}
+		self.callbacks = {}
+
+	# Sets an input level from the simulated hardware and calls its
+	# edge callback if the change matches.
+	def set_input(self, pin, level):
+		with self.lock:
+			old = self.levels.get(pin, 0)
+			self.levels[pin] = level
+		if old == level or pin not in self.callbacks:
+			return
+		(edge, callback) = self.callbacks[pin]
+		rising = level > old
+		if callback is not None and (edge == self.BOTH or
+				(edge == self.RISING) == rising):
+			callback(pin)
+
+#
+# Simulated cover mechanism on SimGPIO. Counts steps from falling
+# edges of PUL (single steps) or from a simulated pulse train (step()),
+# in the direction set by DIR and only while ENA is low, and opens the
+# home switch input once the cover leaves 'home'. position counts steps
+# from where the simulation started.
+#
+class SimCover():
+	def __init__(self, gpio, home=-500):
+		self.gpio = gpio
+		self.home = home
+		self.position = 0
+		self.steps = 0
+		gpio.cover = self
+
+	def at_home(self):
+		return self.position <= self.home
+
+	def pin_changed(self, pin, level):
+		if pin == PUL and level == 0:
+			self.step(1)
+		elif pin == SWITCH_OUT:
+			self.update_switch()
+
+	# Moves the cover n steps if the driver is enabled.
+	def step(self, n):
+		if n <= 0 or self.gpio.levels.get(ENA, 1) != 0:
+			return
+		direction = 1 if self.gpio.levels.get(DIR, 0) else -1
+		self.position += direction*n
+		self.steps += n
+		self.update_switch()
+
+	# The switch input reads the output pin through the closed
+	# switch, and low once the cover is home.
+	def update_switch(self):
+		powered = self.gpio.levels.get(SWITCH_OUT, 0)
+		self.gpio.set_input(SWITCH_IN,
+				    int(bool(powered) and not self.at_home()))
+
+# Chooses the backend once at import.
+SIM = '--sim' in sys.argv
+if not SIM:
+	try:
+		import RPi.GPIO as GPIO
+	except (ImportError, RuntimeError):
+		print("* RPi.GPIO not available, using simulated GPIO.")
+		SIM = True
+if SIM:
+	GPIO = SimGPIO()
@@ -0,0 +1,145 @@
+import time
+import numpy as np
+from Centroid_DS9 import imexcentroid_batch
+from refractor_scheduler import checkpoint
+
+# Image scale of the refractor camera in arcsec per pixel.
+### TO DO: check direction of camera vs telescope and set image scale ###
+SCALE = .057
+
+# Claudius offset command moving the telescope by a pixel offset
+# (centroid minus fiber position) on the refractor camera.
+def offset_command(xdiff, ydiff, scale=SCALE):
+	if xdiff < 0:
+		xoffset = "nn %s" %abs(scale * xdiff)
+	else:
+		xoffset = "ss %s" %(scale * xdiff)
+	if ydiff < 0:
+		yoffset = "ee %s" %abs(scale * ydiff)
+	else:
+		yoffset = "ww %s" %(scale * ydiff)
+	return xoffset + ";" + yoffset
+
+#
+# Proportional-integral filter of the guide error on one axis, in
+# pixels. Errors inside the deadband are left alone (seeing noise) and
+# each correction is limited to max_step; the integral is clamped to
+# the same range so it cannot wind up while the star is lost.
+#
+class PIController():
+	def __init__(self, kp=0.7, ki=0.1, deadband=0.5, max_step=20.):
+		self.kp = kp
+		self.ki = ki
+		self.deadband = deadband
+		self.max_step = max_step
+		self.integral = 0.
+
+	def reset(self):
+		self.integral = 0.
+
+	# Returns the correction for an error.
+	def update(self, error):
+		if abs(error) < self.deadband:
+			return 0.
+		self.integral += error
+		if self.ki:
+			limit = self.max_step/self.ki
+			self.integral = max(-limit, min(limit, self.integral))
+		step = self.kp*error + self.ki*self.integral
+		return max(-self.max_step, min(self.max_step, step))
+
+#
+# Closed-loop autoguider. Every 'cadence' seconds it takes an exposure,
+# centroids the guide star in a tracking box around its last position,
+# filters the error to the target (the fiber) through a PI controller
+# per axis and sends the correction. Stops when the calling task is
+# cancelled, after n cycles, or when the star is lost for max_lost
+# exposures in a row. The box doubles (up to max_roi) after each miss.
+#
+#   expose() -> (image, end)     image (array or FITS path) and the
+#                                time the exposure ended
+#   send(command)                sends an offset_command
+#
+class Autoguider():
+	def __init__(self, expose, send, target, start, roi=60,
+		     cadence=5., scale=SCALE, max_lost=3, max_roi=400,
+		     controllers=None):
+		self.expose = expose
+		self.send = send
+		self.target = target
+		# Last measured star position.
+		self.position = tuple(start)
+		self.roi = roi
+		self.cadence = cadence
+		self.scale = scale
+		self.max_lost = max_lost
+		self.max_roi = max_roi
+		self.controllers = controllers or (PIController(),
+						   PIController())
+		# One (time, x error, y error, latency) row per cycle with
+		# a star; latency is exposure end to correction sent.
+		self.log = []
+
+	# Guides until stopped. Returns the log.
+	def run(self, n=None):
+		for c in self.controllers:
+			c.reset()
+		roi = self.roi
+		lost = 0
+		cycle = 0
+		while n is None or cycle < n:
+			checkpoint()
+			start = time.time()
+			(image, end) = self.expose()
+			box = [self.position[0], self.position[1], roi, roi]
+			try:
+				(x, y) = imexcentroid_batch(image, [box])[0, :2]
+			except ValueError:
+				# Box (partly) off the frame: count as a miss.
+				(x, y) = (np.nan, np.nan)
+
+			if np.isnan(x):
+				lost += 1
+				if lost >= self.max_lost:
+					print("> Guide star lost.")
+					break
+				roi = min(2*roi, self.max_roi)
+				print("> Guide star not found, searching " \
+				      "%s pixel box." %roi)
+			else:
+				lost = 0
+				roi = self.roi
+				self.position = (x, y)
+				xerr = x - self.target[0]
+				yerr = y - self.target[1]
+				xstep = self.controllers[0].update(xerr)
+				ystep = self.controllers[1].update(yerr)
+				if xstep or ystep:
+					self.send(offset_command(xstep, ystep,
+								 self.scale))
+				latency = time.time() - end
+				self.log.append((end, xerr, yerr, latency))
+				print("> Guide error (%.2f, %.2f) px, " \
+				      "correction (%.2f, %.2f) px, %.2f s." %(
+					      xerr, yerr, xstep, ystep, latency))
+
+			cycle += 1
+			# Wait out the rest of the cadence between
+			# cancellation checks.
+			while time.time() - start < self.cadence:
+				checkpoint()
+				time.sleep(min(0.1, max(0., self.cadence -
+						      (time.time() - start))))
+		return self.log
+
+	# Prints the RMS guide error and the latency of the last run.
+	def summary(self):
+		if not self.log:
+			print("> No guide corrections.")
+			return
+		log = np.array(self.log)
+		rms = np.sqrt(np.mean(log[:, 1]**2 + log[:, 2]**2))
+		print("> %s guide cycles: RMS error %.2f px (%.2f arcsec), " \
+		      "latency %.2f s mean %.2f s max" %(
+			      len(log), rms, rms*self.scale,
+			      log[:, 3].mean(), log[:, 3].max()))
@@ -2,15 +2,23 @@
 # Important: Run using python3
 #
 from PyQt5 import QtCore,QtWidgets
-try:
-	import sys,time,os,threading,queue,fnmatch,subprocess,pyds9
-except ImportError:
-	print("* Need to run refractor_main.py using python3.")
-	sys.exit()
+import sys,time,os,threading,subprocess
 import numpy as np
-import RPi.GPIO as GPIO
-from astropy.io import fits
+from refractor_gpio import GPIO, SIM, SimCover
 from Centroid_DS9 import imexcentroid
+from ReadRegions import get_regions, box_guidebox, Box
+from FindStars import find_stars, pick_star, star_guidebox
+from refractor_camera import CameraClient, convert_capture, \
+			      discard_capture
+from refractor_pipeline import AcquisitionPipeline
+from refractor_stack import FrameStacker
+from refractor_session import FrameManifest
+from refractor_scheduler import Scheduler, HIGH, checkpoint, \
+				current_token
+from refractor_pulse import make_pulser, step_profile
+from refractor_cover import CoverState, cover_state, consistent
+from refractor_ds9 import DS9Session, DS9Error, RegionWatcher
+from refractor_guide import Autoguider, offset_command
 import refractorGUI
 
 # Set terminal output to GUI textBox.
@@ -48,9 +56,30 @@ class switch(object):
 	def pin_stop(self):
 		GPIO.output(self.pin_out, 0)
 
+	# The input reads low once the cover reaches the switch (with
+	# the output pin started).
+	def is_home(self):
+		return GPIO.input(self.pin_in) == 0
+
+	# Calls callback() from the GPIO interrupt thread on the edge
+	# where the switch trips.
+	def watch(self, callback):
+		GPIO.add_event_detect(self.pin_in, GPIO.FALLING,
+				      callback=lambda channel: callback())
+
+	def unwatch(self):
+		GPIO.remove_event_detect(self.pin_in)
+
 # class that controls the refractor cover stepper motor via the 
 # stepper driver board.
 class microStepDriver(QtCore.QObject):
+	# Emitted from the move thread while the cover moves: steps
+	# done and total, motor position, and at the end the move name
+	# ('open'/'close') and whether it completed.
+	progress = QtCore.pyqtSignal(int, int)
+	positionChanged = QtCore.pyqtSignal(int)
+	moveFinished = QtCore.pyqtSignal(str, bool)
+
 	def __init__(self, parent=None):
 		super(self.__class__, self).__init__(parent)
 
@@ -64,13 +93,44 @@ class microStepDriver(QtCore.QObject):
 		self.ENA = 22  
 		# 800/2 pulse/rev * 27 (gear ratio) for 180 deg rotation.
 		self.duration = 10800 
-		# Delay between PUL pulses - effectively sets the 
-		# motor rotation speed.
+		# Delay between PUL pulses of drive() single steps.
 		self.delay = 0.0001 
+		# Cover moves: cruise rate and the rate and acceleration
+		# of the start/stop ramps (steps/s, steps/s^2).
+		self.rate = 5000
+		self.startRate = 1000
+		self.accel = 20000
 		self.gearRatio = 26.8512397
 		self.stepAngle = 1.8  # degrees
 		self.microStep = 4  # which means 800 pulse/rev
 		self.motorPosition = 0
+		# Pause for a possible change of direction.
+		self.settle = 0.5
+		# Interval of progress updates during a move.
+		self.poll = 0.05
+		self.moveThread = None
+		self.halt = threading.Event()
+		# Start and direction of the pulse train being sent.
+		self.origin = 0
+		self.direction = 0
+		# Homing: cruise rate (steps/s) and the most steps to try
+		# before giving up on the switch.
+		self.homeRate = 2000
+		self.homeSteps = 2*self.duration
+		# Steps of the last full homing sweep and how far the
+		# motor ran past the switch.
+		self.stepsToHome = None
+		self.overshoot = None
+		# Cover position saved on every move for the next startup.
+		self.store = CoverState('~/.refractor_cover_sim.json'
+					if SIM else '~/.refractor_cover.json')
+		# The simulated cover starts where the saved state puts it,
+		# or a little open so homing has work to do.
+		if SIM and GPIO.cover is None:
+			state = self.store.load()
+			SimCover(GPIO, -500 if state is None or
+				 state['state'] == 'moving' else
+				 -state['position'])
 
 		# Set GPIO pins and outputs.
 		GPIO.setmode(GPIO.BCM)
@@ -79,6 +139,12 @@ class microStepDriver(QtCore.QObject):
 		GPIO.setup(self.DIR, GPIO.OUT)
 		GPIO.setup(self.ENA, GPIO.OUT)
 
+		# Hardware-timed pulse trains for cover moves (pigpio DMA
+		# waves, or the simulator with simulated GPIO).
+		self.pulser = make_pulser(self.PUL,
+				lambda level: GPIO.output(self.PUL, level),
+				sim=SIM, model=GPIO.cover if SIM else None)
+
 		# Disable stepper motor to prevent idle current.
 		self.disable()
 	
@@ -107,37 +173,173 @@ class microStepDriver(QtCore.QObject):
 		self.stop()
 		time.sleep(self.delay)
 
-	def open_cover(self):
+	# Starts a ramped move of steps in direction +1 (forward) or -1
+	# (reverse) on its own thread and returns immediately. A move
+	# in progress is aborted first.
+	def start_move(self, name, direction, steps):
+		self.abort()
+		self.wait()
+		self.halt.clear()
+		self.moveThread = threading.Thread(target=self._run_move,
+						   args=(name, direction, steps))
+		self.moveThread.daemon = True
+		self.moveThread.start()
+
+	def _run_move(self, name, direction, steps):
+		start = self.motorPosition
+		self.origin = start
+		self.store.save(start, 'moving')
 		self.enable()
-		time.sleep(.5)  # pause for possible change direction
-		self.forward()
-		for x in range(self.duration):
-			self.drive()
-			self.motorPosition += 1
-		self.disable()
-		time.sleep(.5)  # pause for possible change direction
-		print('> Cover open - Motor at position %s' %
-						self.motorPosition)
-		return
+		self.halt.wait(self.settle)
+		if direction > 0:
+			self.forward()
+		else:
+			self.reverse()
+		sending = steps > 0 and not self.halt.is_set()
+		if sending:
+			self.direction = direction
+			self.pulser.send(step_profile(steps, self.rate,
+						      self.startRate,
+						      self.accel))
+		try:
+			while sending and self.pulser.busy() and \
+			      not self.halt.wait(self.poll):
+				self._update(start, direction, steps, True)
+		finally:
+			if sending:
+				self.pulser.stop()
+			done = self._update(start, direction, steps, sending)
+			self.direction = 0
+			self.store.save(self.motorPosition, cover_state(
+					self.motorPosition, self.duration))
+			self.disable()
+		self.halt.wait(self.settle)
+		self.moveFinished.emit(name, done == steps)
+		if done == steps:
+			print('> Cover %s - Motor at position %s' %(
+				'open' if name == 'open' else 'closed',
+				self.motorPosition))
+		else:
+			print('> Cover %s aborted - Motor at position %s' %(
+						name, self.motorPosition))
+
+	# Updates motorPosition from the steps sent so far and reports
+	# it. Returns the steps sent.
+	def _update(self, start, direction, steps, sending):
+		done = self.pulser.sent() if sending else 0
+		self.motorPosition = start + direction*done
+		self.progress.emit(done, steps)
+		self.positionChanged.emit(self.motorPosition)
+		return done
+
+	# Live motor position, including the steps of a train that is
+	# still being sent.
+	def position(self):
+		if self.direction == 0:
+			return self.motorPosition
+		return self.origin + self.direction*self.pulser.sent()
+
+	# Drives the cover in reverse until the home switch trips. The
+	# switch edge callback stops the pulse train straight from the
+	# GPIO interrupt thread, and the steps to home are read from the
+	# train timing at the edge. Sets the switch position as 0 and
+	# returns the steps to home (0 if already home).
+	def home(self, switch):
+		self.abort()
+		self.wait()
+		switch.pin_start()
+		try:
+			time.sleep(0.05)
+			if switch.is_home():
+				self.motorPosition = 0
+				self.store.save(0, 'closed')
+				return 0
+
+			tripped = []
+			def edge():
+				tripped.append(time.time())
+				self.pulser.stop()
+
+			self.enable()
+			time.sleep(self.settle)
+			self.reverse()
+			self.origin = self.motorPosition
+			self.direction = -1
+			# Stays 'moving' if the switch is not found.
+			self.store.save(self.motorPosition, 'moving')
+			switch.watch(edge)
+			try:
+				self.pulser.send(step_profile(self.homeSteps,
+							      self.homeRate,
+							      self.startRate,
+							      self.accel))
+				self.pulser.wait(checkpoint)
+			finally:
+				switch.unwatch()
+				self.pulser.stop()
+				self.motorPosition = self.position()
+				self.direction = 0
+				self.disable()
+			if not tripped:
+				raise RuntimeError("Home switch not found " \
+						   "after %s steps" %(
+							self.pulser.sent()))
+
+			self.stepsToHome = self.pulser.sent(tripped[0])
+			self.overshoot = self.pulser.sent() - self.stepsToHome
+			self.motorPosition = -self.overshoot
+			self.store.save(self.motorPosition, 'closed')
+			self.positionChanged.emit(self.motorPosition)
+			return self.stepsToHome
+		finally:
+			switch.pin_stop()
+
+	# Takes over a saved position without moving.
+	def restore(self, position):
+		self.motorPosition = position
+
+	# Stops the move in progress between steps.
+	def abort(self):
+		self.halt.set()
+
+	def moving(self):
+		return self.moveThread is not None and \
+		       self.moveThread.is_alive()
+
+	# Blocks until the move in progress ends. Inside a scheduled
+	# task a cancellation aborts the move.
+	def wait(self):
+		try:
+			while self.moving():
+				checkpoint()
+				self.moveThread.join(self.poll)
+		except BaseException:
+			self.abort()
+			raise
+
+	# Starts a move to an absolute position, so a cover command
+	# after an aborted move only covers the remaining distance.
+	def move_to(self, name, position):
+		self.abort()
+		self.wait()
+		steps = position - self.motorPosition
+		self.start_move(name, 1 if steps >= 0 else -1, abs(steps))
+
+	def open_cover(self):
+		self.move_to('open', self.duration)
 
 	def close_cover(self):
-		self.enable()
-		time.sleep(.5)
-		self.reverse()
-		for y in range(self.duration):
-			self.drive()
-			self.motorPosition -= 1
-		self.disable()
-		time.sleep(.5)
-		print('> Cover closed - Motor at position %s' %
-						self.motorPosition)
-		return
+		self.move_to('close', 0)
 
 	def close(self):
+		self.pulser.close()
 		GPIO.cleanup()
 
 # Main GUI class. Inherits layout from refractorGUI.
 class MainUiClass(QtWidgets.QMainWindow, refractorGUI.Ui_MainWindow):
+	# Emitted when guiding ends, to uncheck the Guide box.
+	guideStopped = QtCore.pyqtSignal()
+
 	def __init__(self, parent=None):
 		super(MainUiClass, self).__init__(parent)
 		self.setupUi(self)
@@ -145,13 +347,39 @@ class MainUiClass(QtWidgets.QMainWindow, refractorGUI.Ui_MainWindow):
 		# Initiate cover microswitch and stepper motor classes.
 		self.switch = switch(20,19)  # microswitch out, in
 		self.motor = microStepDriver()
+		# Progress (percent) and motor position of the cover as
+		# last reported by the motor signals.
+		self.coverProgress = 0
+		self.coverPosition = self.motor.motorPosition
 		
 		# Make sure cover is closed at the home postion.
-		self.cover_home() 
-
-		# Set regions.reg filepath.
-		self.regionpath = '/home/fhire/Desktop/FHiRE-Refractor/ \
-								regions.reg'
+		self.cover_startup()
+
+		### TO DO: Set position of the optical fiber ###
+		self.fiberpos = (2000, 1700)
+		# Stars detected on the last exposure.
+		self.stars = []
+		# One connection to DS9 for the whole session.
+		self.ds9 = DS9Session()
+		# Closed-loop guiding task and its cycle time in seconds.
+		self.guideTask = None
+		self.guideCadence = 5.
+		# Serializes offset commands over the Claudius link.
+		self.claudiusLock = threading.Lock()
+		# Watches DS9 for new or moved box regions.
+		self.regionWatcher = RegionWatcher(self.fetchRegions,
+						   self.regionChanged)
+		# Every frame written this session.
+		self.manifest = FrameManifest()
+		# Combine method for multiple exposures: 'sum', 'mean',
+		# 'median' or 'sigclip'.
+		self.stackMethod = 'sum'
+		# Block-averaging factor of images sent to DS9, and whether
+		# to refresh DS9 with the running stack after every frame.
+		self.displayFactor = 1
+		self.liveDisplay = False
+		self.liveData = None
+		self.liveLock = threading.Lock()
 	
 		# Start threads and connect GUI buttons.
 		self.createThreads()
@@ -166,9 +394,12 @@ class MainUiClass(QtWidgets.QMainWindow, refractorGUI.Ui_MainWindow):
 
 	# Set up threads.
 	def createThreads(self):
-		# Start queue thread.
-		self.q = queue.Queue()
-		self.queueThread()
+		# Start the task lanes.
+		self.scheduler = Scheduler()
+
+		# Start the persistent camera worker. Conversion to FITS
+		# file requires python3.7 so it runs as its own process.
+		self.startCamera()
 
 		######## TEST WHEN UP THE MOUNTAIN ######
 		# Start Claudius thread.
@@ -180,24 +411,27 @@ class MainUiClass(QtWidgets.QMainWindow, refractorGUI.Ui_MainWindow):
 	# Connect buttons to functions.
 	def connectButtons(self):
 		self.closeButton.setChecked(True)
-		self.openButton.clicked.connect(
-				lambda:	self.q.put(self.coverState))
+		self.openButton.clicked.connect(self.submitCover)
 		self.openButton.setToolTip("Opens the refractor" \
 					   "telescope cover.")
 
-		self.closeButton.clicked.connect(
-				lambda: self.q.put(self.coverState))
+		self.closeButton.clicked.connect(self.submitCover)
 		self.closeButton.setToolTip("Closes the refractor" \
 			 		    "telescope cover.")
+		self.motor.progress.connect(self.showCoverProgress)
+		self.motor.positionChanged.connect(self.showCoverPosition)
+		self.motor.moveFinished.connect(self.coverMoved)
 
 		self.exposeButton.pressed.connect(
-				lambda: self.q.put(self.refractor_exp))
+				lambda: self.scheduler.submit(
+						'camera', self.refractor_exp))
 		self.exposeButton.setToolTip("Takes exposures and saves " \
 					     "temporary FITS image to " \
 					     "~/Desktop/Images.")
 
 		self.ds9Button.clicked.connect(
-				lambda: self.q.put(self.openDS9))
+				lambda: self.scheduler.submit(
+						'ds9', self.openDS9))
 		self.ds9Button.setToolTip("Opens a new ds9 window.")
 
 		self.centroidButton.clicked.connect(lambda: self.preCentroid())
@@ -205,6 +439,16 @@ class MainUiClass(QtWidgets.QMainWindow, refractorGUI.Ui_MainWindow):
 					       "sends offsets to Claudius.\n" \
 					       "Set a box region around " \
 					       "desired star in DS9 first.")
+		self.guideBox.toggled.connect(self.toggleGuide)
+		self.guideBox.setToolTip("Guides continuously: exposes " \
+					 "every few seconds, centroids the " \
+					 "guide star and sends corrections.")
+		self.guideStopped.connect(
+				lambda: self.guideBox.setChecked(False))
+		self.autoCentroidBox.toggled.connect(self.autoCentroid)
+		self.autoCentroidBox.setToolTip("Centroids and sends offsets " \
+						"as soon as a box region is " \
+						"drawn or moved in DS9.")
 
 		# Set default time and number of exposures and call 
 		# update function.
@@ -221,22 +465,6 @@ class MainUiClass(QtWidgets.QMainWindow, refractorGUI.Ui_MainWindow):
 		self.updateExp()
 		#print ('Buttons are connected.')
 
-	# Runner that performs tasks in queue in order.
-	# This way multiple functions aren't called at once and the 
-	# GUI doesnt freeze up.
-	def queueRunner(self):
-		while True:
-			f = self.q.get()
-			f()
-			self.q.task_done()
-
-	# Thread that runs the queue.
-	def queueThread(self):
-		queueWorker = threading.Thread(target=self.queueRunner)
-		# Daemon thread will close when application is closed.
-		queueWorker.setDaemon(True)
-		queueWorker.start()
-
 	# Updates the number and length of exposures when spin wheels
 	# are changed.
 	def updateExp(self):
@@ -247,6 +475,34 @@ class MainUiClass(QtWidgets.QMainWindow, refractorGUI.Ui_MainWindow):
 	def setClaudiuslnk(self,lnk):
 		self.claudiuslnk = lnk
 
+	# Queues a cover move ahead of other motor work. The move runs
+	# on the motor's own thread, so the lane is free again at once;
+	# a new cover command aborts the move in progress.
+	def submitCover(self):
+		self.scheduler.cancel('motor')
+		self.scheduler.submit('motor', self.coverState, priority=HIGH)
+
+	# Keeps the progress of the cover move for the status bar.
+	def showCoverProgress(self, done, total):
+		self.coverProgress = 100*done//max(total, 1)
+
+	# Shows cover progress and position in the status bar.
+	def showCoverPosition(self, position):
+		self.coverPosition = position
+		self.statusBar().showMessage("Cover %d%% - Motor at " \
+					     "position %s" %(
+						self.coverProgress, position))
+
+	# Shows the outcome of a cover move in the status bar.
+	def coverMoved(self, name, done):
+		if done:
+			state = 'open' if name == 'open' else 'closed'
+		else:
+			state = name + ' aborted'
+		self.statusBar().showMessage("Cover %s - Motor at " \
+					     "position %s" %(
+						state, self.coverPosition))
+
 	# Calls motor to open or close cover when radio button is changed.
 	def coverState(self):
 		if self.openButton.isChecked() == True:
@@ -257,172 +513,259 @@ class MainUiClass(QtWidgets.QMainWindow, refractorGUI.Ui_MainWindow):
 			print ("> Closing cover...")
 			self.motor.close_cover()
 
-	# Finds files in a folder.
-	def find(self, pattern, path):
-		result = []
-		for root, dirs, files in os.walk(path):
-			for name in files:
-				if fnmatch.fnmatch(name, pattern):
-					result.append(os.path.join(root, name))
-		return result
+	# Starts the camera worker. It keeps the camera open
+	# with fixed gains between exposures. Run the GUI with --sim
+	# to use the stand-in camera, which runs on this interpreter
+	# as it does not need picamera.
+	def startCamera(self):
+		cmd = ["python3.7", os.path.join(os.path.dirname(
+				os.path.abspath(__file__)), "refractor_camera.py"),
+		       "--serve"]
+		if '--sim' in sys.argv:
+			cmd[0] = sys.executable
+			cmd.append('--sim')
+		self.cameraproc = subprocess.Popen(cmd)
+		self.camera = None
+
+	# Connects to the camera worker on first use, restarting the
+	# worker if it has exited.
+	def cameraClient(self):
+		if self.cameraproc.poll() is not None:
+			print("> Camera worker exited, restarting it...")
+			self.dropCamera()
+			self.startCamera()
+		if self.camera is None:
+			self.camera = CameraClient()
+		return self.camera
+
+	# Closes the connection to the camera worker, so the next
+	# request reconnects.
+	def dropCamera(self):
+		if self.camera is not None:
+			try:
+				self.camera.conn.close()
+			except OSError:
+				pass
+		self.camera = None
+
+	# Takes an exposure on the camera worker without converting it.
+	# A broken connection (worker crashed) is retried once on a
+	# fresh connection, restarting the worker if needed.
+	def cameraCapture(self, expTime):
+		try:
+			return self.cameraClient().capture(expTime)
+		except (OSError, EOFError):
+			self.dropCamera()
+		return self.cameraClient().capture(expTime)
+
 	#
 	# Takes exposures, converts to FITS file and saves path to 
-	# guiding image. Conversion to FITS file requires python3.7 
-	# so have to call the script from terminal.
+	# guiding image. Exposures are requested from the camera 
+	# worker started by startCamera.
 	#
 	def refractor_exp(self):		
-		# Delete any old images.
-		old_images = self.find('RefractorImage*', 
-				       '/home/fhire/Desktop/FHiRE-Refractor')
-		if old_images:
-			os.system("rm RefractorImage_temp*")
-		else:
-			pass
+		# Delete the images of the previous sequence.
+		self.manifest.purge()
+		self.manifest.new_sequence()
 
 		# Read the number and time exp spin boxes and take
-		# that many images. Conversion to fits takes longer
-		# than exposure and happens immediately for each exposure.
-		#print("> Please wait for exposure(s) and conversion.")
-		for x in range(0, self.num_exp):
-	
+		# that many images. The camera keeps exposing while
+		# earlier frames are converted to fits here, and each
+		# frame is added to the stack as soon as it is converted,
+		# so memory does not grow with num_exp.
+		stacker = FrameStacker(self.stackMethod)
+
+		# The capture thread stops the sequence if the task is
+		# cancelled or times out.
+		token = current_token()
+
+		def capture(x):
+			token.check()
 			print("> Taking %s of %s exposure(s)..." %(
 						x+1, self.num_exp))
-
-			proc = subprocess.Popen(["python3.7", 
-					         "refractor_camera.py", 
-					         str(self.time_exp)])
-			proc.wait()  
-			(stdout, stderr) = proc.communicate()
-		
-			#if proc.returncode != 0:
-			#	print("> ERROR: Camera not connected.")
-			#	return
-
+			return self.cameraCapture(self.time_exp)
+
+		def convert(x, raw):
+			return convert_capture(raw)
+
+		def consume(x, path):
+			frame = self.manifest.add(path, 'frame', self.time_exp)
+			if self.num_exp > 1:
+				stacker.add(frame.path)
+				if self.liveDisplay and \
+				   self.stackMethod in ('sum', 'mean'):
+					self.showLive(np.array(stacker.result()))
 			print("> Exposure %s of %s complete and converted." %(
 							   x+1, self.num_exp))
-		
-		# If more than one exposure stack images.
+
+		def discard(x, raw):
+			discard_capture(raw)
+
+		pipeline = AcquisitionPipeline(capture, convert, consume,
+					       discard)
+		try:
+			pipeline.run(self.num_exp)
+		except (OSError, EOFError, RuntimeError) as err:
+			print("> ERROR: Camera not connected. %s" %err)
+			return
 		if self.num_exp > 1:
-			image_list = self.find(
-					'*.fits', 
-					'/home/fhire/Desktop/FHiRE-Refractor')
-			image_concat = [fits.getdata(image) for image in image_list]
-			final_image = np.sum(image_concat, axis=0)
+			pipeline.summary()
 
+		# If more than one exposure stack images.
+		if self.num_exp > 1:
 			outfile = 'RefractorImage_temp-stacked.fits'
-			hdu = fits.PrimaryHDU(final_image)
-			hdu.writeto(outfile, overwrite=True)
-			self.imgpath = "/home/fhire/Desktop/FHiRE-Refractor" \
-				       "/RefractorImage_temp" \
-				       "-stacked.fits"
-			self.img = 'RefractorImage_temp-stacked.fits'
+			image = stacker.result()
+			stacker.write(outfile, image)
+			frame = self.manifest.add(outfile, 'stack',
+					self.time_exp * self.num_exp)
+			self.imgpath = frame.path
 			print ("> Exposure stack saved to %s" %self.imgpath)
-			self.openDS9(True)
+			# The stack is already in memory, so DS9 gets it
+			# from there rather than from the file.
+			self.scheduler.submit('ds9', self.showImage, image)
+			self.detectStars(image)
 
 		# Otherwise, don't stack.
 		else:
-			self.imgpath = "/home/fhire/Desktop/FHiRE-Refractor" \
-				       "/RefractorImage_temp-G.fits"
-			self.img = 'RefractorImage_temp-G.fits'
+			self.imgpath = self.manifest.latest('frame').path
 			print ("> Exposure saved to %s." %self.imgpath)
-			self.openDS9(True)
+			self.scheduler.submit('ds9', self.openDS9, True)
+			self.detectStars()
+
+	# Shows an image array in DS9 from memory.
+	def showImage(self, data):
+		print("> Opening image in ds9...")
+		try:
+			self.ds9.show(data, self.displayFactor)
+		except DS9Error as err:
+			print("> ERROR: Cannot reach ds9. %s" %err)
+
+	# Queues a live display refresh. Only the newest frame is
+	# shown if DS9 falls behind.
+	def showLive(self, data):
+		with self.liveLock:
+			pending = self.liveData is not None
+			self.liveData = data
+		if not pending:
+			self.scheduler.submit('ds9', self._showLive)
+
+	def _showLive(self):
+		with self.liveLock:
+			(data, self.liveData) = (self.liveData, None)
+		try:
+			self.ds9.show(data, self.displayFactor)
+		except DS9Error as err:
+			print("> ERROR: Cannot reach ds9. %s" %err)
+
+	# Finds stars on the last exposure so a guide star can be
+	# centroided without drawing a box region in DS9. Uses the
+	# image array if given instead of reading imgpath.
+	def detectStars(self, image=None):
+		try:
+			self.stars = find_stars(self.imgpath if image is None
+						else image)
+		except (IOError, ValueError):
+			self.stars = []
+			print("> ERROR: Star detection failed.")
+			return
+		star = pick_star(self.stars, self.fiberpos)
+		if star is None:
+			print("> No stars detected.")
+			return
+		print("> %s star(s) detected. Guide star at (%.1f, %.1f)." %(
+					len(self.stars), star[0], star[1]))
 
 	# Opens DS9 and shows last exposure if it exists.
 	def openDS9(self, image=False):
 		if image == False:
 			print("> Opening ds9...")			
-		# Opens DS9 or points to existing window if already open.
-		pyds9.DS9()
-		# If called after taking an exposure open that exposure.
-		if image == True:
-			print("> Opening image in ds9...")
-			os.system('xpaset -p ds9 fits ' + str(self.imgpath))
-			os.system('xpaset -p ds9 zoom to fit')
-			os.system('xpaset -p ds9 zscale')
-		elif image == False:
-			print("> ds9 opened.")
+		try:
+			# Opens DS9 or points to existing window if already
+			# open, and keeps the connection.
+			self.ds9.connect()
+			# If called after taking an exposure open that
+			# exposure.
+			if image == True:
+				print("> Opening image in ds9...")
+				self.ds9.batch(['fits ' + str(self.imgpath),
+						'zoom to fit',
+						'zscale'])
+			elif image == False:
+				print("> ds9 opened.")
+		except DS9Error as err:
+			print("> ERROR: Cannot reach ds9. %s" %err)
+
+	# Restores the cover position saved by the last session. The
+	# home switch is read once; only a missing or inconsistent
+	# state needs the full homing sweep.
+	def cover_startup(self):
+		state = self.motor.store.load()
+		self.switch.pin_start()
+		time.sleep(0.05)
+		home = self.switch.is_home()
+		self.switch.pin_stop()
+		if not consistent(state, home):
+			print("> Cover state unknown or inconsistent.")
+			self.cover_home()
+			return
+
+		self.motor.restore(state['position'])
+		if state['state'] == 'closed':
+			print("> Refractor cover verified home.")
+			return
+		# Close with a normal move; homing then only checks the
+		# switch or finishes the last few steps.
+		print("> Closing cover from position %s." %state['position'])
+		self.motor.close_cover()
+		self.motor.wait()
+		self.cover_home()
 
 	# Closes cover until home switch is triggered. Called at 
 	# beginning and end of GUI.
 	def cover_home(self):
 		print("> Sending refractor cover home.")
-		self.motor.enable()
-		self.motor.reverse()
-		time.sleep(.5)  # pause for possible change direction
-		self.switch.pin_start()
-		time.sleep(0.05)
-		if GPIO.input(19) == 1:  # if not at home send home
-			while GPIO.input(19) == 1:
-				self.motor.drive()
-		self.switch.pin_stop()
-		print("> Refractor cover sent home.")
-		self.motor.disable()
+		try:
+			steps = self.motor.home(self.switch)
+		except RuntimeError as err:
+			print("> ERROR: %s" %err)
+			return
+		if steps:
+			print("> Refractor cover sent home in %s steps " \
+			      "(%s past the switch)." %(
+				      steps, self.motor.overshoot))
+		else:
+			print("> Refractor cover already home.")
 	
 	# Centroiding method.
-	def mycen(self):
+	# Centroids in the given guidebox, or in the first box region
+	# in DS9 if none is given.
+	def mycen(self, guidebox=None):
 		# Temporary path for testing.
 		#self.imgpath='/home/fhire/Desktop/Refractor/GAMimage.fit' 
 		try:
-			### TO DO: Set position of the optical fiber ###
-			subprocess.run(["xpaset", 
-					"-p", 
-					"ds9", 
-					"regions", 
-					"command", 
-					"{point 2000 1700 # point=x " \
-							"20 color=red}"], 
-								check=True)
-		
-			# Save current ds9 regions to reg file and 
-			# then read and compute centroid.
-			subprocess.run(["xpaset", 
-					"-p", 
-					"ds9", 
-					"regions", 
-					"save", self.regionpath], 
-							check=True)
+			if guidebox is None:
+				guidebox = self.findGuidebox()
 
 			try:
 				[xcenter, ycenter] = imexcentroid(
 							self.imgpath, 
-							self.regionpath)
+							guidebox)
 			except:
 				print("> ERROR: Image not found.")
+				return
 
 			# Compute the offset and display.
-			### TO DO: Set position of the optical fiber ###
-			xdiff = xcenter - 2000
-			ydiff = ycenter - 1700
-
-			### TO DO: check direction of camera vs telescope
-			# and set image scale ###
-			if xdiff < 0:
-				xoffset = "nn %s" %abs(.057 * xdiff)
-			elif xdiff >= 0:
-				xoffset = "ss %s" %(.057 * xdiff)
-			if ydiff < 0:
-				yoffset = "ee %s" %abs(.057 * ydiff)
-			elif ydiff >= 0:
-				yoffset = "ww %s" %(.057 * ydiff)	
-		
-			print("(%s, %s)" %(xcenter, ycenter))
-			print("%s %s" %(xoffset, yoffset))
-
-			move_offset = (xoffset + ";" + yoffset)
+			xdiff = xcenter - self.fiberpos[0]
+			ydiff = ycenter - self.fiberpos[1]
+			move_offset = offset_command(xdiff, ydiff)
 
-			### TO DO: TEST WHEN UP THE MOUNTAIN ###
-			# send offset command to Claudius
-			#print("<span style=\"color:#0000ff;\">" \
-			#      "<b>observer@claudius: </b>" + " \
-			#      "move_offset + "</span>")
-			#self.claudiuslnk.sendline(move_offset)
-			#self.claudiuslnk.prompt()
-			#print("<span style=\"color:#0000ff;\">" + " \
-			#      "self.claudiuslnk.before + "</span>")
+			print("(%s, %s)" %(xcenter, ycenter))
+			print(move_offset.replace(";", " "))
+			self.sendOffset(move_offset)
 
 		# Catch errors if DS9 not open, there is no region in
 		# DS9, or no exposure.
-		except subprocess.CalledProcessError:
+		except DS9Error:
 			print ('> ERROR: Cannot find image in DS9.')
 		except AttributeError:
 			print ("> ERROR: No exposure found. Take an " \
@@ -431,6 +774,123 @@ class MainUiClass(QtWidgets.QMainWindow, refractorGUI.Ui_MainWindow):
 			print ("> ERROR: No region found in DS9. Draw a " \
 			       "box region around a star to centroid.")
 
+	# Sends an offset command to Claudius.
+	### TO DO: TEST WHEN UP THE MOUNTAIN ###
+	# Guiding and centroiding both send, so one command and its
+	# reply go over the link at a time.
+	def sendOffset(self, move_offset):
+		if not hasattr(self, 'claudiuslnk'):
+			print("> Claudius not connected, offset not sent.")
+			return
+		with self.claudiusLock:
+			print("<span style=\"color:#0000ff;\">" \
+			      "<b>observer@claudius: </b>" + \
+			      move_offset + "</span>")
+			self.claudiuslnk.sendline(move_offset)
+			self.claudiuslnk.prompt()
+			print("<span style=\"color:#0000ff;\">" + \
+			      self.claudiuslnk.before + "</span>")
+
+	# Turns closed-loop guiding on or off.
+	def toggleGuide(self, on):
+		if on:
+			if self.guideTask is None or \
+			   self.guideTask.finished.is_set():
+				self.guideTask = self.scheduler.submit(
+						'camera', self.guide,
+						name='Guiding')
+		elif self.guideTask is not None:
+			self.guideTask.cancel()
+
+	# Guides on the star in the first DS9 box region, or the
+	# detected guide star, with exposures of the set length every
+	# guideCadence seconds until the Guide box is unchecked.
+	def guide(self):
+		box = None
+		if self.ds9.connected():
+			try:
+				box = self.findGuidebox()
+			except (DS9Error, ValueError):
+				pass
+		star = pick_star(self.stars, self.fiberpos)
+		if box is None and star is not None:
+			box = star_guidebox(star)
+		if box is None:
+			print("> ERROR: No guide star. Take an exposure " \
+			      "or draw a box region in DS9.")
+			self.guideStopped.emit()
+			return
+
+		# Only the newest guide frame is kept on disk.
+		self.manifest.purge(self.manifest.find('guide'))
+		def expose():
+			capture = self.cameraCapture(self.time_exp)
+			path = convert_capture(capture, 'RefractorImage_guide')
+			frame = self.manifest.add(path, 'guide', self.time_exp)
+			self.manifest.purge(self.manifest.find('guide')[:-1])
+			return (frame.path, capture['end'])
+
+		guider = Autoguider(expose, self.sendOffset, self.fiberpos,
+				    box[:2], cadence=self.guideCadence)
+		print("> Guiding on star at (%.1f, %.1f)." %(box[0], box[1]))
+		try:
+			guider.run()
+		except (OSError, EOFError, RuntimeError) as err:
+			print("> ERROR: Camera not connected. %s" %err)
+		finally:
+			guider.summary()
+			frame = self.manifest.latest('guide')
+			if frame is not None:
+				self.imgpath = frame.path
+			self.guideStopped.emit()
+
+	# Marks the fiber, then reads the current ds9 regions straight
+	# over XPA and returns the first box, or a box around the
+	# detected guide star.
+	def findGuidebox(self):
+		self.ds9.set("regions command {point %s %s " \
+			     "# point=x 20 color=red}" %self.fiberpos)
+		boxes = [r for r in get_regions(self.ds9)
+			 if isinstance(r, Box)]
+
+		# Without a box region fall back to the detected guide
+		# star.
+		star = pick_star(self.stars, self.fiberpos)
+		if boxes:
+			return box_guidebox(boxes[0])
+		elif star is not None:
+			print("> No box region in DS9. Using detected " \
+			      "star at (%.1f, %.1f)." %(star[0], star[1]))
+			return star_guidebox(star)
+		raise ValueError("No guidebox")
+
+	# Reads the DS9 regions for the region watcher. Returns None
+	# rather than starting DS9 when it is not open.
+	def fetchRegions(self):
+		if not self.ds9.connected():
+			return None
+		try:
+			return get_regions(self.ds9)
+		except DS9Error:
+			return None
+
+	# Turns centroiding on region changes on or off.
+	def autoCentroid(self, on):
+		if on:
+			self.regionWatcher.start()
+			print("> Auto centroid on. Draw or move a box " \
+			      "region in DS9.")
+		else:
+			self.regionWatcher.stop()
+			print("> Auto centroid off.")
+
+	# Centroids and offsets on a box region that was just drawn or
+	# moved in DS9.
+	def regionChanged(self, box):
+		print("> Box region at (%.1f, %.1f)." %(box.x, box.y))
+		self.scheduler.submit('telescope', self.mycen,
+				      box_guidebox(box))
+
 	# Centroid warning message to set region in DS9.
 	def preCentroid(self):
 		msg = QtWidgets.QMessageBox.information(
@@ -446,7 +906,7 @@ class MainUiClass(QtWidgets.QMainWindow, refractorGUI.Ui_MainWindow):
 					QtWidgets.QMessageBox.No)
 		if msg == QtWidgets.QMessageBox.Yes:
 			print("> Beginning offset.")
-			self.q.put(self.mycen)
+			self.scheduler.submit('telescope', self.mycen)
 
 		elif msg == QtWidgets.QMessageBox.No:
 			print('Offset canceled.')
@@ -468,12 +928,31 @@ class MainUiClass(QtWidgets.QMainWindow, refractorGUI.Ui_MainWindow):
 			print("Wait while refractor cover closes.")
 			event.accept()
 			#self.claudiuslnk.logout() 
+			# Stop running tasks (a cover move stops between
+			# steps) before sending the cover home.
+			self.regionWatcher.stop()
+			self.scheduler.shutdown(timeout=10.)
+			self.motor.abort()
+			self.motor.wait()
 			self.cover_home()
 			self.motor.close()
+			self.stopCamera()
+			self.ds9.summary()
 			print("Window Closed.")
 		else:
 			event.ignore()
 
+	# Stops the camera worker.
+	def stopCamera(self):
+		if self.camera is None:
+			self.cameraproc.terminate()
+		else:
+			try:
+				self.camera.shutdown()
+			except (OSError, EOFError, RuntimeError):
+				self.cameraproc.terminate()
+		self.cameraproc.wait()
+
 	# Restores sys.stdout and sys.stderr.
 	def __del__(self):
 		sys.stdout=sys.__stdout__
@@ -0,0 +1,161 @@
+import time, threading, queue
+
+# Marks the end of the frame stream in the queues.
+_DONE = object()
+
+#
+# Producer/consumer acquisition pipeline. One thread keeps the camera
+# exposing while a pool of converter threads turns earlier captures into
+# fits and one consumer thread (stacking, bookkeeping) takes the results
+# in frame order. The queues are bounded, so when conversion falls
+# behind the camera waits instead of piling raw frames up in memory.
+#
+#   capture(i) -> raw        takes exposure i
+#   convert(i, raw) -> out   converts it (runs in parallel)
+#   consume(i, out)          called once per frame, in order
+#   discard(i, raw)          cleans up captures left unconverted
+#                            when a run stops on an error
+#
+class AcquisitionPipeline():
+	def __init__(self, capture, convert, consume=None, discard=None,
+		     workers=2, depth=2):
+		self.capture = capture
+		self.convert = convert
+		self.consume = consume
+		self.discard = discard
+		self.workers = max(1, workers)
+		# Captures allowed to wait for a converter.
+		self.depth = max(1, depth)
+		self.stats = {'capture': [], 'convert': [], 'wait': []}
+
+	# Runs n frames and returns the converted results in order.
+	# The first error raised by any stage stops the camera and is
+	# raised again here.
+	def run(self, n):
+		self.raw = queue.Queue(maxsize=self.depth)
+		self.done = queue.Queue(maxsize=self.depth + self.workers)
+		self.stop = threading.Event()
+		self.error = None
+		self.results = [None]*n
+		for key in self.stats:
+			self.stats[key] = []
+
+		start = time.time()
+		threads = [threading.Thread(target=self._produce, args=(n,))]
+		threads += [threading.Thread(target=self._convert)
+			    for i in range(self.workers)]
+		threads.append(threading.Thread(target=self._consume,
+						 args=(n,)))
+		for t in threads:
+			t.daemon = True
+			t.start()
+		for t in threads:
+			t.join()
+		self.elapsed = time.time() - start
+
+		while not self.raw.empty():
+			self._drop(self.raw.get())
+		if self.error is not None:
+			raise self.error
+		return self.results
+
+	# Prints the stage timings of the last run.
+	def summary(self):
+		def mean(values):
+			return sum(values)/len(values) if values else 0.
+		print("%d frames in %.2f s: capture %.2f s, convert %.2f s, " \
+		      "camera waited %.2f s per frame" %(
+			      len(self.stats['capture']), self.elapsed,
+			      mean(self.stats['capture']),
+			      mean(self.stats['convert']),
+			      mean(self.stats['wait'])))
+
+	def _drop(self, item):
+		if item is not _DONE and self.discard is not None:
+			try:
+				self.discard(*item)
+			except Exception:
+				pass
+
+	def _fail(self, error):
+		if self.error is None:
+			self.error = error
+		self.stop.set()
+
+	# Puts an item on a bounded queue unless the run is stopped.
+	def _put(self, q, item):
+		while not self.stop.is_set():
+			try:
+				q.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def _get(self, q):
+		while not self.stop.is_set():
+			try:
+				return q.get(timeout=0.1)
+			except queue.Empty:
+				pass
+		return _DONE
+
+	def _produce(self, n):
+		try:
+			for i in range(n):
+				if self.stop.is_set():
+					return
+				t0 = time.time()
+				raw = self.capture(i)
+				t1 = time.time()
+				if not self._put(self.raw, (i, raw)):
+					self._drop((i, raw))
+					return
+				self.stats['capture'].append(t1 - t0)
+				self.stats['wait'].append(time.time() - t1)
+		except Exception as e:
+			self._fail(e)
+		finally:
+			for w in range(self.workers):
+				self._put(self.raw, _DONE)
+
+	def _convert(self):
+		while True:
+			item = self._get(self.raw)
+			if item is _DONE:
+				return
+			if self.stop.is_set():
+				self._drop(item)
+				continue
+			(i, raw) = item
+			try:
+				t0 = time.time()
+				out = self.convert(i, raw)
+				self.stats['convert'].append(time.time() - t0)
+			except Exception as e:
+				self._fail(e)
+				self._drop(item)
+				return
+			if not self._put(self.done, (i, out)):
+				return
+
+	# Hands results to consume in frame order, holding back frames
+	# that finished converting early.
+	def _consume(self, n):
+		pending = {}
+		i = 0
+		while i < n:
+			item = self._get(self.done)
+			if item is _DONE:
+				return
+			pending[item[0]] = item[1]
+			while i in pending:
+				out = pending.pop(i)
+				self.results[i] = out
+				try:
+					if self.consume is not None:
+						self.consume(i, out)
+				except Exception as e:
+					self._fail(e)
+					return
+				i += 1
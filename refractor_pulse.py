@@ -0,0 +1,288 @@
+import time, threading, bisect
+import numpy as np
+
+try:
+	import pigpio
+	pigpio_loaded = True
+except ImportError:
+	pigpio_loaded = False
+
+# Builds the step profile of a move as [(period_us, count), ...]: a
+# linear speed ramp from start_rate up to rate (steps/s) with accel
+# (steps/s^2), a cruise, and the same ramp down. The ramp speeds are
+# quantized to a few levels so a DMA wave can be built per level.
+def step_profile(steps, rate, start_rate=None, accel=None, levels=32):
+	if steps <= 0:
+		return []
+	if start_rate is None or accel is None or start_rate >= rate:
+		return [(int(round(1e6/rate)), int(steps))]
+	i = np.arange(steps)
+	# Speed reachable after i steps from either end of the move.
+	up = np.sqrt(start_rate**2 + 2.*accel*i)
+	down = np.sqrt(start_rate**2 + 2.*accel*(steps - 1 - i))
+	speed = np.minimum(np.minimum(up, down), rate)
+	frac = np.round((speed - start_rate)/(rate - start_rate)*(levels - 1))
+	speed = start_rate + frac/(levels - 1)*(rate - start_rate)
+	period = np.round(1e6/speed).astype(int)
+
+	# Run-length encode the per-step periods.
+	edges = np.flatnonzero(np.diff(period)) + 1
+	starts = np.concatenate(([0], edges))
+	counts = np.diff(np.concatenate((starts, [steps])))
+	return [(int(period[s]), int(n)) for s, n in zip(starts, counts)]
+
+# Duration of a profile in seconds.
+def profile_time(profile):
+	return sum(period*count for period, count in profile)/1e6
+
+#
+# Base of the pulse-train backends. A backend plays a whole step
+# profile in the background; the caller polls busy() and can stop()
+# it at any time. sent() tells how many steps went out, from the time
+# the train has been running.
+#
+class Pulser():
+	# Rate of the train clock relative to real time (simulation).
+	scale = 1.
+
+	def __init__(self):
+		self.profile = []
+		self.start = None
+		self.stopped = None
+
+	# Starts a step profile and returns immediately.
+	def send(self, profile):
+		self.profile = list(profile)
+		periods = np.array([p for p, n in self.profile], dtype=float)
+		counts = np.array([n for p, n in self.profile], dtype=int)
+		self.counts = np.cumsum(counts)
+		self.ends = np.cumsum(periods*counts)/1e6
+		self.periods = periods/1e6
+		self.stopped = None
+		self.start = None
+		self._send(self.profile)
+		# Timed from when the train is going out, not from before
+		# the backend built it.
+		self.start = time.time()
+		self._started()
+
+	def busy(self):
+		return False
+
+	# Stops the pulse train.
+	def stop(self):
+		if self.stopped is None and self.start is not None:
+			self.stopped = time.time()
+		self._stop()
+
+	# Waits for the train to end. check() is called between polls,
+	# e.g. a cancellation checkpoint; the train is stopped if it
+	# raises.
+	def wait(self, check=None, poll=0.01):
+		try:
+			while self.busy():
+				if check is not None:
+					check()
+				time.sleep(poll)
+		except BaseException:
+			self.stop()
+			raise
+
+	# Number of steps sent by time t (default: now or when stopped).
+	def sent(self, t=None):
+		if self.start is None or not self.profile:
+			return 0
+		if t is None:
+			t = self.stopped if self.stopped is not None \
+				else time.time()
+		elapsed = (t - self.start)*self.scale
+		j = int(np.searchsorted(self.ends, elapsed, side='right'))
+		if j >= len(self.profile):
+			return int(self.counts[-1])
+		before = self.counts[j-1] if j else 0
+		begin = self.ends[j-1] if j else 0.
+		return int(before + (elapsed - begin)//self.periods[j])
+
+	def close(self):
+		self.stop()
+
+	def _send(self, profile):
+		pass
+
+	def _started(self):
+		pass
+
+	def _stop(self):
+		pass
+
+#
+# Hardware-timed step pulses through the pigpio daemon. Each distinct
+# period of the profile becomes one single-step DMA wave, and the
+# profile is played as a wave chain with a repeat count per segment,
+# so the step timing does not depend on Python at all. The driver
+# steps on the falling edge of PUL (active low, idle high).
+#
+class PigpioPulser(Pulser):
+	def __init__(self, pin, host='localhost'):
+		super(PigpioPulser, self).__init__()
+		if not pigpio_loaded:
+			raise RuntimeError("pigpio is not installed")
+		self.pin = pin
+		self.pi = pigpio.pi(host)
+		if not self.pi.connected:
+			raise RuntimeError("pigpio daemon not running " \
+					   "(start it with 'sudo pigpiod')")
+		self.pi.set_mode(pin, pigpio.OUTPUT)
+		self.pi.write(pin, 1)
+
+	def _send(self, profile):
+		self.pi.wave_tx_stop()
+		self.pi.wave_clear()
+		mask = 1 << self.pin
+		waves = {}
+		chain = []
+		for period, count in profile:
+			if period not in waves:
+				low = period // 2
+				self.pi.wave_add_generic([
+					pigpio.pulse(0, mask, low),
+					pigpio.pulse(mask, 0, period - low)])
+				waves[period] = self.pi.wave_create()
+			# Wave chain loops count at most 65535 times.
+			while count > 0:
+				n = min(count, 65535)
+				chain += [255, 0, waves[period],
+					  255, 1, n & 255, n >> 8]
+				count -= n
+		self.pi.wave_chain(chain)
+
+	def busy(self):
+		return bool(self.pi.wave_tx_busy())
+
+	def _stop(self):
+		self.pi.wave_tx_stop()
+		self.pi.write(self.pin, 1)
+
+	def close(self):
+		self.stop()
+		self.pi.wave_clear()
+		self.pi.stop()
+
+#
+# Stand-in backend that sends no pulses and only keeps time, so moves
+# take as long as on the real motor and can be stopped part way. With
+# a model (refractor_gpio.SimCover) a follower thread feeds it the steps
+# as they go out, so the simulated home switch trips mid-train. scale
+# speeds the clock up for benchmarks.
+#
+class SimPulser(Pulser):
+	def __init__(self, model=None, scale=1., poll=0.0005):
+		super(SimPulser, self).__init__()
+		self.model = model
+		self.scale = scale
+		self.poll = poll
+		self.follower = None
+
+	def _send(self, profile):
+		self.done = 0
+
+	def _started(self):
+		if self.model is not None:
+			self.follower = threading.Thread(target=self._follow)
+			self.follower.daemon = True
+			self.follower.start()
+
+	def _follow(self):
+		while True:
+			busy = self.busy()
+			sent = self.sent()
+			if sent > self.done:
+				self.model.step(sent - self.done)
+				self.done = sent
+			if not busy:
+				return
+			time.sleep(self.poll)
+
+	def busy(self):
+		return self.start is not None and self.stopped is None and \
+		       len(self.ends) > 0 and \
+		       (time.time() - self.start)*self.scale < self.ends[-1]
+
+	# Waits for the follower to hand over the last steps, unless
+	# stopped from the follower itself (a switch edge callback).
+	def _stop(self):
+		if self.follower is not None and \
+		   self.follower is not threading.current_thread():
+			self.follower.join()
+
+#
+# Software-timed fallback for a Pi without the pigpio daemon. Pulses
+# are toggled by a thread that busy-waits on the clock; steadier than
+# sleep() but still subject to scheduling jitter.
+#
+class SoftPulser(Pulser):
+	def __init__(self, output):
+		super(SoftPulser, self).__init__()
+		# output(level) sets the PUL pin.
+		self.output = output
+		self.thread = None
+		self.halt = threading.Event()
+		self.count = 0
+		self.times = []
+
+	def _send(self, profile):
+		self.halt.clear()
+		self.count = 0
+		self.times = []
+		self.thread = threading.Thread(target=self._run,
+					       args=(profile,))
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _run(self, profile):
+		clock = time.perf_counter
+		t = clock()
+		for period, count in profile:
+			low = period/2e6
+			high = period/1e6 - low
+			for n in range(count):
+				if self.halt.is_set():
+					return
+				self.output(0)
+				t += low
+				while clock() < t:
+					pass
+				self.output(1)
+				self.times.append(time.time())
+				self.count += 1
+				t += high
+				while clock() < t:
+					pass
+
+	def busy(self):
+		return self.thread is not None and self.thread.is_alive()
+
+	# Steps actually toggled (by time t if given, from the time
+	# stamp of each step); the timing may have slipped.
+	def sent(self, t=None):
+		if t is None:
+			return self.count
+		return bisect.bisect_right(self.times, t)
+
+	def _stop(self):
+		self.halt.set()
+		if self.thread is not None and \
+		   self.thread is not threading.current_thread():
+			self.thread.join()
+
+# Picks the pulse backend for a PUL pin: the simulator if sim is set
+# (driving model if given), else pigpio DMA waves, else software timing
+# through output(level).
+def make_pulser(pin, output=None, sim=False, model=None):
+	if sim:
+		return SimPulser(model)
+	try:
+		return PigpioPulser(pin)
+	except RuntimeError as err:
+		print("> %s. Using software step timing." %err)
+		return SoftPulser(output)
@@ -0,0 +1,201 @@
+import time, threading, queue, itertools, traceback
+
+# Task priorities, lower runs first.
+HIGH = 0
+NORMAL = 10
+LOW = 20
+
+# Raised inside a task by checkpoint() once it is cancelled.
+class TaskCancelled(Exception):
+	pass
+
+# Raised inside a task by checkpoint() once its timeout has passed.
+class TaskTimeout(TaskCancelled):
+	pass
+
+# The task running on the current lane thread.
+_current = threading.local()
+
+#
+# Cancellation token of one task. Long tasks call checkpoint() (or
+# token.check()) between steps; the scheduler cannot interrupt a
+# thread, so a task that never checks runs to the end.
+#
+class CancelToken():
+	def __init__(self, timeout=None):
+		self.event = threading.Event()
+		self.timeout = timeout
+		self.deadline = None
+
+	def cancel(self):
+		self.event.set()
+
+	@property
+	def cancelled(self):
+		return self.event.is_set()
+
+	# Starts the timeout clock; called when the task starts running.
+	def start(self):
+		if self.timeout is not None:
+			self.deadline = time.time() + self.timeout
+
+	# Raises TaskCancelled or TaskTimeout if the task should stop.
+	def check(self):
+		if self.event.is_set():
+			raise TaskCancelled()
+		if self.deadline is not None and time.time() > self.deadline:
+			raise TaskTimeout()
+
+# Returns the token of the task running on this thread, e.g. to hand
+# to helper threads of the task. Outside a task returns a token that is
+# never cancelled.
+def current_token():
+	task = getattr(_current, 'task', None)
+	if task is None:
+		return CancelToken()
+	return task.token
+
+# Checks the token of the task running on this thread. Does nothing
+# outside a scheduled task.
+def checkpoint():
+	task = getattr(_current, 'task', None)
+	if task is not None:
+		task.token.check()
+
+#
+# One submitted call. state is 'queued', 'running', 'done', 'failed'
+# or 'cancelled'.
+#
+class Task():
+	def __init__(self, lane, fn, args, kwargs, priority, timeout, name):
+		self.lane = lane
+		self.fn = fn
+		self.args = args
+		self.kwargs = kwargs
+		self.priority = priority
+		self.name = name or getattr(fn, '__name__', 'task')
+		self.token = CancelToken(timeout)
+		self.state = 'queued'
+		self.result = None
+		self.error = None
+		self.finished = threading.Event()
+
+	def cancel(self):
+		self.token.cancel()
+
+	# Waits for the task and returns its result; raises its error.
+	def wait(self, timeout=None):
+		if not self.finished.wait(timeout):
+			raise TaskTimeout("%s still running" %self.name)
+		if self.error is not None:
+			raise self.error
+		return self.result
+
+#
+# Priority queue with its own worker thread. Tasks of one lane run
+# one at a time; tasks of different lanes run concurrently.
+#
+class Lane():
+	def __init__(self, name):
+		self.name = name
+		self.q = queue.PriorityQueue()
+		self.running = None
+		self.thread = threading.Thread(target=self.run,
+					       name='lane-' + name)
+		# Daemon thread will close when application is closed.
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		while True:
+			(priority, seq, task) = self.q.get()
+			if task is None:
+				return
+			if task.token.cancelled:
+				task.state = 'cancelled'
+				task.finished.set()
+				continue
+			self.running = task
+			_current.task = task
+			task.state = 'running'
+			task.token.start()
+			try:
+				task.result = task.fn(*task.args, **task.kwargs)
+				task.state = 'done'
+			except TaskTimeout as e:
+				task.error = e
+				task.state = 'cancelled'
+				print("> %s timed out." %task.name)
+			except TaskCancelled as e:
+				task.error = e
+				task.state = 'cancelled'
+				print("> %s cancelled." %task.name)
+			except Exception as e:
+				task.error = e
+				task.state = 'failed'
+				print("> ERROR: %s failed: %s" %(task.name, e))
+				traceback.print_exc()
+			finally:
+				_current.task = None
+				self.running = None
+				task.finished.set()
+
+#
+# Task scheduler replacing the single FIFO queue runner. Work is
+# submitted to a named lane (motor, camera, ds9, telescope) so a long
+# exposure sequence does not hold up a cover move or a centroid. Within
+# a lane higher priority tasks run first, in submission order for equal
+# priority.
+#
+class Scheduler():
+	lanes = ('motor', 'camera', 'ds9', 'telescope')
+
+	def __init__(self, lanes=None):
+		self.lanes = {name: Lane(name) for name in (lanes or self.lanes)}
+		self.counter = itertools.count()
+
+	# Queues fn(*args, **kwargs) on a lane and returns its Task.
+	# timeout (seconds from start) is enforced at checkpoints.
+	def submit(self, lane, fn, *args, priority=NORMAL, timeout=None,
+		   name=None, **kwargs):
+		task = Task(lane, fn, args, kwargs, priority, timeout, name)
+		self.lanes[lane].q.put((priority, next(self.counter), task))
+		return task
+
+	# Cancels the queued and running tasks of a lane (default: all
+	# lanes). Returns the number of tasks cancelled.
+	def cancel(self, lane=None):
+		count = 0
+		for l in self._select(lane):
+			with l.q.mutex:
+				tasks = [item[2] for item in l.q.queue]
+			if l.running is not None:
+				tasks.append(l.running)
+			for task in tasks:
+				if task is not None and not task.token.cancelled:
+					task.cancel()
+					count += 1
+		return count
+
+	# True if a lane (default: any lane) has a task running or queued.
+	def busy(self, lane=None):
+		return any(l.running is not None or not l.q.empty()
+			   for l in self._select(lane))
+
+	# Stops the lane threads after their queued tasks, waiting at
+	# most timeout seconds in total (None waits for all).
+	def shutdown(self, cancel=True, timeout=None):
+		if cancel:
+			self.cancel()
+		for l in self.lanes.values():
+			# Sorts after every real task.
+			l.q.put((float('inf'), next(self.counter), None))
+		end = None if timeout is None else time.time() + timeout
+		for l in self.lanes.values():
+			l.thread.join(None if end is None else
+				      max(0., end - time.time()))
+
+	def _select(self, lane):
+		if lane is None:
+			return list(self.lanes.values())
+		return [self.lanes[lane]]
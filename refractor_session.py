@@ -0,0 +1,61 @@
+import os, time, threading
+from collections import namedtuple
+
+# One file produced by the acquisition pipeline.
+Frame = namedtuple('Frame', 'path kind exptime timestamp sequence')
+
+#
+# In-process record of every frame the GUI produces this session
+# (single exposures, stacks and guide frames), so stacking, cleanup and
+# centroiding look frames up directly instead of scanning the working
+# tree.
+#
+class FrameManifest():
+	def __init__(self):
+		self.frames = []
+		self.sequence = 0
+		self.lock = threading.Lock()
+
+	# Starts a new exposure sequence and returns its number.
+	def new_sequence(self):
+		with self.lock:
+			self.sequence += 1
+			return self.sequence
+
+	# Records a frame of the current sequence and returns it.
+	def add(self, path, kind='frame', exptime=None, timestamp=None):
+		frame = Frame(os.path.abspath(path), kind, exptime,
+			      time.time() if timestamp is None else timestamp,
+			      self.sequence)
+		with self.lock:
+			self.frames.append(frame)
+		return frame
+
+	# Returns the frames of a kind ('frame', 'stack', 'guide' or
+	# None for all), optionally of one sequence, oldest first.
+	def find(self, kind=None, sequence=None):
+		with self.lock:
+			return [f for f in self.frames
+				if (kind is None or f.kind == kind) and
+				   (sequence is None or f.sequence == sequence)]
+
+	# Returns the newest frame of a kind, or None.
+	def latest(self, kind=None):
+		frames = self.find(kind)
+		return frames[-1] if frames else None
+
+	# Deletes the files of the given frames (default: all) and
+	# forgets them.
+	def purge(self, frames=None):
+		with self.lock:
+			if frames is None:
+				frames = self.frames
+			frames = list(frames)
+			self.frames = [f for f in self.frames
+				       if f not in frames]
+		for f in frames:
+			try:
+				os.remove(f.path)
+			except FileNotFoundError:
+				pass
+		return len(frames)
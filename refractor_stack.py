@@ -0,0 +1,121 @@
+import numpy as np
+from astropy.io import fits
+from Centroid_DS9 import _FitsCutout
+
+#
+# Streaming frame stacker. Sum and mean combine accumulate every frame
+# into one preallocated buffer as soon as it is added, so memory does
+# not grow with the number of frames. Median and sigma-clipped combine
+# need all frames per pixel; they keep only the file paths and read the
+# frames back in row chunks that fit in a fixed memory budget.
+#
+class FrameStacker():
+	methods = ('sum', 'mean', 'median', 'sigclip')
+
+	def __init__(self, method='sum', dtype=np.float32, budget=64*2**20,
+		     nsigma=3., iters=3):
+		if method not in self.methods:
+			raise ValueError("Unknown stack method %s" %method)
+		self.method = method
+		self.dtype = np.dtype(dtype)
+		# Working memory in bytes used by median/sigclip.
+		self.budget = budget
+		self.nsigma = nsigma
+		self.iters = iters
+		self.shape = None
+		self.total = None
+		self.paths = []
+		self.count = 0
+
+	# Adds a frame: a FITS file path or (sum/mean only) an array.
+	def add(self, frame):
+		if self.method in ('sum', 'mean'):
+			if isinstance(frame, str):
+				frame = fits.getdata(frame)
+			self._check_shape(frame.shape)
+			if self.total is None:
+				self.total = np.zeros(self.shape, self.dtype)
+			np.add(self.total, frame, out=self.total,
+			       casting='unsafe')
+		else:
+			if not isinstance(frame, str):
+				raise TypeError("%s combine needs FITS file " \
+						"paths" %self.method)
+			self._check_shape(_fits_shape(frame))
+			self.paths.append(frame)
+		self.count += 1
+
+	# Returns the combined frame.
+	def result(self):
+		if self.count == 0:
+			raise ValueError("No frames to stack")
+		if self.method == 'sum':
+			return self.total
+		if self.method == 'mean':
+			return self.total / self.dtype.type(self.count)
+		return self._combine_chunks()
+
+	# Writes the combined frame (or data, if already combined) to a
+	# FITS file.
+	def write(self, outfile, data=None):
+		hdu = fits.PrimaryHDU(self.result() if data is None else data)
+		hdu.header.set('NCOMBINE', self.count)
+		hdu.header.set('COMBINE', self.method)
+		hdu.writeto(outfile, overwrite=True)
+		return outfile
+
+	def _check_shape(self, shape):
+		if self.shape is None:
+			self.shape = tuple(shape)
+		elif tuple(shape) != self.shape:
+			raise ValueError("Frame shape %s does not match " \
+					 "stack shape %s" %(shape, self.shape))
+
+	# Median or sigma-clipped mean, a block of rows at a time.
+	def _combine_chunks(self):
+		(ny, nx) = self.shape
+		# The chunk plus the temporaries of np.median (one copy)
+		# or of the clipping (deviations and mask).
+		copies = 2 if self.method == 'median' else 3
+		rowbytes = copies * len(self.paths) * nx * self.dtype.itemsize
+		rows = max(1, int(self.budget // rowbytes))
+		out = np.empty(self.shape, self.dtype)
+		hdulists = [fits.open(path, memmap=True,
+				      do_not_scale_image_data=True)
+			    for path in self.paths]
+		try:
+			frames = [_FitsCutout(h[0]) for h in hdulists]
+			chunk = np.empty((len(frames), rows, nx), self.dtype)
+			for y1 in range(0, ny, rows):
+				y2 = min(y1 + rows, ny)
+				block = chunk[:, :y2 - y1]
+				for i, frame in enumerate(frames):
+					block[i] = frame[y1:y2]
+				if self.method == 'median':
+					out[y1:y2] = np.median(block, axis=0)
+				else:
+					out[y1:y2] = self._sigclip(block)
+		finally:
+			for h in hdulists:
+				h.close()
+		return out
+
+	# Iterative sigma-clipped mean along the frame axis. Uses the
+	# median and MAD so a single outlier cannot inflate the clip
+	# level; clipped values are set to NaN in the scratch block.
+	def _sigclip(self, block):
+		for i in range(self.iters):
+			center = np.nanmedian(block, axis=0)
+			dev = np.abs(block - center)
+			sigma = 1.4826 * np.nanmedian(dev, axis=0)
+			clip = dev > self.nsigma * sigma
+			if not clip.any():
+				break
+			block[clip] = np.nan
+		return np.nanmean(block, axis=0)
+
+# Image shape from a FITS header, without reading the data.
+def _fits_shape(path):
+	header = fits.getheader(path)
+	return tuple(header['NAXIS%d' % n]
+		     for n in range(header['NAXIS'], 0, -1))